@@ -1,10 +1,38 @@
 import asyncio
+import bisect
+import contextlib
+import hashlib
+import heapq
+import hmac
+import io
+import itertools
 import json
 import logging
+import math
+import mmap
+import multiprocessing
 import os
-from telegram import Update, InputMediaPhoto, InputMediaVideo, InputMediaDocument, Sticker, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes, Application
-from telegram.error import Forbidden
+import random
+import secrets
+import signal
+import sqlite3
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from telegram import Update, ChatMember, ChatPermissions, InputMediaPhoto, InputMediaVideo, InputMediaDocument, Sticker, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import ApplicationBuilder, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, MessageHandler, ChatMemberHandler, TypeHandler, filters, ContextTypes, Application
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+from telegram.request import BaseRequest, HTTPXRequest
+
+# Optional: perceptual hashing of photos (pip install Pillow)
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 # Disable logging for `httpx`
 logging.getLogger("httpx").setLevel(logging.WARNING)
@@ -16,109 +44,1673 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+
+# Durations of the startup phases, logged once the bot is ready for updates
+class StartupTimer:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._last = self.started
+        self.phases = []
+
+    # Record the time since the previous checkpoint as phase `name`
+    def checkpoint(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now - self._last))
+        self._last = now
+
+    # Record a phase that overlaps others, e.g. one running on a thread
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - started))
+
+    def report(self):
+        phases = ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in self.phases)
+        return f"{phases}; ready after {(time.perf_counter() - self.started) * 1000:.0f} ms"
+
+
+startup_timer = StartupTimer()
+
 # Constants
 OWNER_ID = '7574316340'  # Replace with the actual owner ID
-DATA_FILE = "data.json"
+DATA_FILE = "data.json"  # Legacy JSON state, imported into DB_FILE once
 DEFAULT_AUTO_DELETE_TIME = 30 * 60  # Default auto delete time in seconds (30 minutes)
 
-# Data Structures
-authorized_users = set()
-authorized_user_ids = set()
-started_users = set()
-group_ids = set()
-global_authorized_users = set()
-group_authorized_users = {}
-group_settings = {}
-
-# Load data from JSON file
-def load_data():
-    try:
-        with open(DATA_FILE, "r") as file:
-            content = file.read().strip()
-            if not content:
-                logger.info(f"{DATA_FILE} is empty. Creating default data.")
-                return {}
-            return json.loads(content)
-    except (json.JSONDecodeError, FileNotFoundError) as e:
-        logger.error(f"Error loading data: {e}")
-        return {}
-
-# Save data to JSON file
-def save_data():
-    data = {
-        "started_users": list(started_users),
-        "group_ids": list(group_ids),
-        "authorized_users": list(authorized_users),
-        "authorized_user_ids": list(authorized_user_ids),
-        "global_authorized_users": list(global_authorized_users),
-        "group_authorized_users": {k: list(v) for k, v in group_authorized_users.items()},
-        "group_settings": group_settings
+DATA_RELOAD_INTERVAL = 2  # Seconds between checks of the database for external changes
+STATE_CHANGES_KEEP = 10_000  # Recent row changes kept for other processes to catch up from
+DB_FILE = "bot.db"
+JOURNAL_DB_FILE = "journal.db"  # Pending deletions and broadcast progress, kept apart from the state tables
+MEDIA_DB_FILE = "media.db"  # Flagged media ids
+MEDIA_BLOCKLIST_FILE = os.environ.get("MEDIA_BLOCKLIST_FILE", "blocklist.txt")  # Shared file_unique_id blocklist
+BLOOM_MIN_CAPACITY = 100_000  # Flagged ids the in-memory Bloom filter is sized for at least
+BLOOM_ERROR_RATE = 0.001
+PHASH_WORKERS = int(os.environ.get("PHASH_WORKERS", 0))  # Processes hashing photos; 0 disables perceptual matching
+PHASH_MAX_DISTANCE = 6  # Differing bits (of 64) for two photos to count as the same
+PHASH_MAX_PENDING = 32  # Photo checks running at once before new photos are skipped
+DELETE_FLUSH_INTERVAL = float(os.environ.get("DELETE_FLUSH_INTERVAL", 1))  # Seconds between batched deletions
+DELETE_BATCH_SIZE = 100  # Maximum message ids per deleteMessages call
+BOT_API_BASE_URL = os.environ.get("BOT_API_BASE_URL", "https://api.telegram.org/bot")
+BROADCAST_WORKERS = 8  # Concurrent senders per broadcast
+BOT_API_RATE = float(os.environ.get("BOT_API_RATE", 30))  # Global Bot API calls per second
+PRIVATE_CHAT_RATE = 1  # Messages per second to one private chat
+GROUP_CHAT_RATE = 20 / 60  # Messages per second to one group (20 per minute)
+GROUP_CHAT_BURST = 20
+CHAT_BUCKETS_SIZE = 10000  # Chats whose send rate is tracked at once
+API_MAX_RETRIES = 3
+RETRY_BASE_DELAY = 0.5  # Seconds; doubled on every retry after a network error, with full jitter
+RETRY_AFTER_JITTER = 1  # Extra random seconds added to a RetryAfter pause
+BOT_API_POOL_SIZE = int(os.environ.get("BOT_API_POOL_SIZE", 64))  # Pooled keep-alive connections to the Bot API
+BOT_API_CONNECT_TIMEOUT = 5
+BOT_API_READ_TIMEOUT = 15
+BOT_API_WRITE_TIMEOUT = 15
+BOT_API_POOL_TIMEOUT = 10  # Seconds to wait for a free pooled connection
+ADMIN_CACHE_TTL = 300  # Seconds a chat's administrator list is trusted
+ADMIN_CACHE_SIZE = 1024  # Chats kept in the administrator cache
+CHAT_SCAN_CONCURRENCY = 10  # Parallel get_chat calls when validating groups
+CHAT_INFO_TTL = 3600  # Seconds a group's title and liveness stay cached
+CHAT_REFRESH_INTERVAL = 1800  # Seconds between background refreshes of group info
+STATE_FLUSH_INTERVAL = 2  # Seconds between commits of changed users, groups, authorizations and settings
+STATE_FLUSH_BATCH = 500  # Changed rows that trigger an early commit
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", "snapshots")  # Rotating copies of the state databases
+SNAPSHOT_INTERVAL = 3600  # Seconds between snapshots
+SNAPSHOT_KEEP = 24  # Snapshots kept per database
+MESSAGE_LOG_DIR = os.environ.get("MESSAGE_LOG_DIR", "message_log")  # One ring file of recent message ids per group
+MESSAGE_LOG_SIZE = 4096  # Most recent messages remembered per group
+MESSAGE_LOG_OPEN_MAX = 1024  # Group ring files kept mapped at once
+BOT_DELETE_MAX_AGE = 48 * 3600  # Bots cannot delete messages older than this
+FLOOD_MAX_COUNTERS = 100_000  # (chat, user) message counters kept by the flood detector
+JOB_CONCURRENCY = 2  # Background jobs (broadcasts, group listings) running at once; the rest wait
+JOB_PROGRESS_INTERVAL = 3  # Minimum seconds between edits of a job's status message
+JOBS_LISTED = 10  # Most recent jobs shown by /jobs
+EDIT_ANNOUNCE_WINDOW = 30  # Seconds further edits by the same user in a chat are summed into one announcement
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", 16))  # Chats whose updates are processed concurrently
+MAX_PENDING_UPDATES = 4096  # Updates queued or being handled before receiving more waits
+
+# Runtime mode: "polling" (default) or "webhook"
+RUN_MODE = os.environ.get("BOT_RUN_MODE", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")  # Public base URL Telegram posts updates to
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 8443))
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")  # Generated at startup when unset
+WEBHOOK_MAX_BODY = 1 << 20  # Bytes; larger request bodies are refused without being read
+HTTP_READ_TIMEOUT = 10  # Seconds a client gets to send a request's headers, and again its body
+HTTP_MAX_HEADERS = 100  # Header lines per request
+HTTP_MAX_HEADER_BYTES = 16 * 1024  # Bytes of header lines per request, and of any single line
+SHUTDOWN_DRAIN_TIMEOUT = 10  # Seconds to wait for in-flight HTTP requests on shutdown
+UPDATE_LOG_FILE = os.environ.get("UPDATE_LOG_FILE")  # Append every raw update here for offline replay
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9464))  # Serves /metrics; 0 disables the endpoint
+
+# Supervisor mode: one process receives updates and routes them by chat to worker processes
+SHARDS = int(os.environ.get("BOT_SHARDS", 0))  # Worker processes; 0 handles everything in one process
+SHARD_CHECK_INTERVAL = 5  # Seconds between checks for worker processes that exited
+
+
+# Prometheus-style metrics, cheap enough to stay enabled on the hot path
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.kind = "counter"
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def total(self):
+        return sum(self.values.values())
+
+    def samples(self):
+        for label_values, value in self.values.items():
+            yield self.name, dict(zip(self.labels, label_values)), value
+
+
+class Histogram:
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.kind = "histogram"
+        self.buckets = buckets
+        self.values = {}  # label values -> [bucket counts..., +Inf count, sum, count]
+
+    def observe(self, value, *label_values):
+        entry = self.values.get(label_values)
+        if entry is None:
+            entry = self.values[label_values] = [0] * (len(self.buckets) + 3)
+        entry[bisect.bisect_left(self.buckets, value)] += 1
+        entry[-2] += value
+        entry[-1] += 1
+
+    def mean(self):
+        total = sum(entry[-2] for entry in self.values.values())
+        count = sum(entry[-1] for entry in self.values.values())
+        return total / count if count else 0.0
+
+    def samples(self):
+        for label_values, entry in self.values.items():
+            labels = dict(zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry):
+                cumulative += count
+                yield f"{self.name}_bucket", {**labels, "le": str(bound)}, cumulative
+            yield f"{self.name}_bucket", {**labels, "le": "+Inf"}, entry[-1]
+            yield f"{self.name}_sum", labels, entry[-2]
+            yield f"{self.name}_count", labels, entry[-1]
+
+
+# Value read from elsewhere (e.g. a queue length) at scrape time
+class CallbackMetric:
+    def __init__(self, name, help_text, kind, func):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.func = func
+
+    def samples(self):
+        yield self.name, {}, self.func()
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help_text, labels=()):
+        return self._register(Counter(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=Histogram.DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, labels, buckets))
+
+    def callback(self, name, help_text, kind, func):
+        return self._register(CallbackMetric(name, help_text, kind, func))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    # Prometheus text exposition format
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                label_text = ",".join(f'{key}="{value}"' for key, value in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+MESSAGES_SEEN = metrics.counter("bot_messages_seen_total", "Messages seen per chat.", ("chat_id",))
+UPDATE_LATENCY = metrics.histogram("bot_update_seconds", "Time spent running handlers for one update.")
+DELETIONS_SCHEDULED = metrics.counter("bot_deletions_scheduled_total", "Message deletions scheduled.")
+DELETION_LAG = metrics.histogram("bot_deletion_lag_seconds", "Delay between a deletion falling due and being sent.")
+BOT_API_CALLS = metrics.counter("bot_api_calls_total", "Bot API calls by method.", ("method",))
+BOT_API_RATE_LIMITED = metrics.counter("bot_api_rate_limited_total", "Bot API calls answered with 429.", ("method",))
+BOT_API_LATENCY = metrics.histogram("bot_api_seconds", "Bot API call latency by method.", ("method",))
+BOT_API_RETRIES = metrics.counter("bot_api_retries_total", "Bot API calls retried by reason.", ("method", "reason"))
+BOT_API_COALESCED = metrics.counter("bot_api_coalesced_total", "Bot API reads answered by an identical in-flight call.", ("method",))
+BOT_API_QUEUE_WAIT = metrics.histogram("bot_api_queue_seconds", "Time Bot API calls waited for the rate limiter.", ("lane",))
+BROADCAST_SENDS = metrics.counter("bot_broadcast_sends_total", "Broadcast deliveries by result.", ("result",))
+ADMIN_LOOKUPS = metrics.counter("bot_admin_lookups_total", "Admin checks by how they were answered.", ("result",))
+STORAGE_WRITES = metrics.counter("bot_storage_writes_total", "Storage write transactions by operation.", ("operation",))
+FLAGGED_MEDIA_DELETIONS = metrics.counter("bot_flagged_media_deletions_total", "Messages deleted because their media was flagged.")
+FLOOD_DELETIONS = metrics.counter("bot_flood_deletions_total", "Messages deleted for exceeding a group's flood limit.")
+FLOOD_RESTRICTIONS = metrics.counter("bot_flood_restrictions_total", "Users muted by the flood detector, by result.", ("result",))
+JOBS_FINISHED = metrics.counter("bot_jobs_finished_total", "Background jobs by kind and final status.", ("kind", "status"))
+EDITED_MESSAGES = metrics.counter("bot_edited_messages_total", "Edited messages by the action taken.", ("action",))
+PHASH_CHECKS = metrics.counter("bot_phash_checks_total", "Perceptual photo checks by outcome.", ("result",))
+STORAGE_WRITE_LATENCY = metrics.histogram("bot_storage_write_seconds", "Storage write transaction latency.")
+SHARD_UPDATES = metrics.counter("bot_shard_updates_total", "Updates routed to each shard by the receiver.", ("shard",))
+
+
+# Set of Telegram ids kept as a sorted array of 64-bit ints
+class IdSet:
+    """Compact stand-in for a set of int ids.
+
+    Ids live in a sorted array('q') at 8 bytes each, instead of the 60-odd
+    bytes an int costs inside a set, and membership is a binary search.
+    Recent additions and removals wait in two small sets and are merged into
+    the array once they outgrow 1/64 of it, so add() does not shift the
+    whole array. Iteration yields ids in ascending order.
+    """
+
+    MERGE_MIN = 1024  # Pending changes always allowed before a merge
+
+    def __init__(self, ids=()):
+        self._ids = array("q", sorted(set(ids)))
+        self._added = set()  # ids not in the array
+        self._removed = set()  # ids in the array that were discarded
+
+    # Build from strictly increasing ids, e.g. an ORDER BY on a primary key
+    @classmethod
+    def from_sorted(cls, ids):
+        id_set = cls()
+        id_set._ids = array("q", ids)
+        return id_set
+
+    @classmethod
+    def from_bytes(cls, blob):
+        ids = array("q")
+        ids.frombytes(blob)
+        if sys.byteorder == "big":
+            ids.byteswap()
+        return cls.from_sorted(ids)
+
+    # Little-endian int64 ids in ascending order
+    def to_bytes(self):
+        self._merge()
+        if sys.byteorder == "big":
+            ids = array("q", self._ids)
+            ids.byteswap()
+            return ids.tobytes()
+        return self._ids.tobytes()
+
+    def _in_array(self, id_):
+        ids = self._ids
+        i = bisect.bisect_left(ids, id_)
+        return i < len(ids) and ids[i] == id_
+
+    def _merge(self):
+        if not self._added and not self._removed:
+            return
+        removed = self._removed
+        kept = [i for i in self._ids if i not in removed] if removed else self._ids
+        # `kept` is already sorted and timsort takes it as one run, so this costs about
+        # sorting the few added ids plus one linear merge, all in C
+        self._ids = array("q", sorted(itertools.chain(kept, self._added)))
+        self._added = set()
+        self._removed = set()
+
+    def _maybe_merge(self):
+        if len(self._added) + len(self._removed) > max(self.MERGE_MIN, len(self._ids) >> 6):
+            self._merge()
+
+    def __contains__(self, id_):
+        if id_ in self._added:
+            return True
+        return id_ not in self._removed and self._in_array(id_)
+
+    def __len__(self):
+        return len(self._ids) + len(self._added) - len(self._removed)
+
+    def __iter__(self):
+        ids = self._ids
+        if self._removed:
+            removed = set(self._removed)
+            ids = (i for i in ids if i not in removed)
+        if not self._added:
+            return iter(ids)
+        return heapq.merge(ids, sorted(self._added))
+
+    def __or__(self, other):
+        merged = sorted(itertools.chain(self, other))
+        return IdSet.from_sorted(key for key, _ in itertools.groupby(merged))
+
+    __ror__ = __or__
+
+    def __repr__(self):
+        return f"IdSet({len(self)} ids)"
+
+    def add(self, id_):
+        if id_ in self._removed:
+            self._removed.discard(id_)
+        elif id_ not in self._added and not self._in_array(id_):
+            self._added.add(id_)
+            self._maybe_merge()
+
+    def discard(self, id_):
+        if id_ in self._added:
+            self._added.discard(id_)
+        elif id_ not in self._removed and self._in_array(id_):
+            self._removed.add(id_)
+            self._maybe_merge()
+
+
+# Open a connection to the bot's SQLite database
+def open_db(path=DB_FILE, check_same_thread=True):
+    conn = sqlite3.connect(path, check_same_thread=check_same_thread)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+# Transactional storage for users, groups, authorizations and settings
+class Storage:
+    """SQLite (WAL) persistence behind BotState.
+
+    Changes are written as batches of row-level upserts and deletes, so a
+    write costs O(rows changed) regardless of how much state the bot holds.
+    Global authorizations are stored with chat_id GLOBAL_CHAT_ID and setting
+    values are JSON encoded.
+
+    The connection is shared under `lock`, so the bot's own commits never
+    look like external changes to data_version(). Commits are fsynced
+    (synchronous=FULL): a crash loses at most the changes still waiting in
+    the writer, never committed ones. The lock is held through that fsync,
+    so once the bot runs, the connection is only used on the StateWriter
+    thread (see StateWriter.run_in_thread()), never on the event loop.
+
+    Triggers log every row inserted, updated or deleted, by this process,
+    another shard or the sqlite3 shell, to state_changes in StateWriter key
+    form, so other processes apply just the rows that changed instead of
+    reloading everything. Only the last STATE_CHANGES_KEEP are kept.
+    """
+
+    GLOBAL_CHAT_ID = 0
+
+    # Statements for ("user" | "group" | "auth", *key) rows, by whether the row should exist
+    ROW_STATEMENTS = {
+        "user": {
+            True: "INSERT OR IGNORE INTO users VALUES (?)",
+            False: "DELETE FROM users WHERE user_id = ?",
+        },
+        "group": {
+            True: "INSERT OR IGNORE INTO groups VALUES (?)",
+            False: "DELETE FROM groups WHERE chat_id = ?",
+        },
+        "auth": {
+            True: "INSERT OR IGNORE INTO authorizations VALUES (?, ?)",
+            False: "DELETE FROM authorizations WHERE chat_id = ? AND user_id = ?",
+        },
     }
-    with open(DATA_FILE, "w") as file:
-        json.dump(data, file, indent=4)
-
-# Authorize a user
-def authorize_user(user_id):
-    if user_id not in authorized_user_ids:
-        authorized_user_ids.add(user_id)
-        authorized_users.append(user_id)
-        logger.info(f"User {user_id} authorized!")
-    else:
-        logger.info(f"User {user_id} is already authorized.")
+    SETTING_STATEMENT = "INSERT OR REPLACE INTO group_settings VALUES (?, ?, ?)"
+    # Values are JSON; a deleted setting logs NULL
+    CHANGE_LOG_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS state_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, chat_id INTEGER, item, value TEXT);
+        CREATE TRIGGER IF NOT EXISTS users_logged_insert AFTER INSERT ON users BEGIN
+            INSERT INTO state_changes (kind, item, value) VALUES ('user', NEW.user_id, 'true'); END;
+        CREATE TRIGGER IF NOT EXISTS users_logged_delete AFTER DELETE ON users BEGIN
+            INSERT INTO state_changes (kind, item, value) VALUES ('user', OLD.user_id, 'false'); END;
+        CREATE TRIGGER IF NOT EXISTS users_logged_update AFTER UPDATE ON users BEGIN
+            INSERT INTO state_changes (kind, item, value) VALUES ('user', OLD.user_id, 'false'), ('user', NEW.user_id, 'true'); END;
+        CREATE TRIGGER IF NOT EXISTS groups_logged_insert AFTER INSERT ON groups BEGIN
+            INSERT INTO state_changes (kind, item, value) VALUES ('group', NEW.chat_id, 'true'); END;
+        CREATE TRIGGER IF NOT EXISTS groups_logged_delete AFTER DELETE ON groups BEGIN
+            INSERT INTO state_changes (kind, item, value) VALUES ('group', OLD.chat_id, 'false'); END;
+        CREATE TRIGGER IF NOT EXISTS groups_logged_update AFTER UPDATE ON groups BEGIN
+            INSERT INTO state_changes (kind, item, value) VALUES ('group', OLD.chat_id, 'false'), ('group', NEW.chat_id, 'true'); END;
+        CREATE TRIGGER IF NOT EXISTS authorizations_logged_insert AFTER INSERT ON authorizations BEGIN
+            INSERT INTO state_changes (kind, chat_id, item, value) VALUES ('auth', NEW.chat_id, NEW.user_id, 'true'); END;
+        CREATE TRIGGER IF NOT EXISTS authorizations_logged_delete AFTER DELETE ON authorizations BEGIN
+            INSERT INTO state_changes (kind, chat_id, item, value) VALUES ('auth', OLD.chat_id, OLD.user_id, 'false'); END;
+        CREATE TRIGGER IF NOT EXISTS authorizations_logged_update AFTER UPDATE ON authorizations BEGIN
+            INSERT INTO state_changes (kind, chat_id, item, value)
+            VALUES ('auth', OLD.chat_id, OLD.user_id, 'false'), ('auth', NEW.chat_id, NEW.user_id, 'true'); END;
+        CREATE TRIGGER IF NOT EXISTS group_settings_logged_insert AFTER INSERT ON group_settings BEGIN
+            INSERT INTO state_changes (kind, chat_id, item, value) VALUES ('setting', NEW.chat_id, NEW.name, NEW.value); END;
+        CREATE TRIGGER IF NOT EXISTS group_settings_logged_delete AFTER DELETE ON group_settings BEGIN
+            INSERT INTO state_changes (kind, chat_id, item, value) VALUES ('setting', OLD.chat_id, OLD.name, NULL); END;
+        CREATE TRIGGER IF NOT EXISTS group_settings_logged_update AFTER UPDATE ON group_settings BEGIN
+            INSERT INTO state_changes (kind, chat_id, item, value)
+            VALUES ('setting', OLD.chat_id, OLD.name, NULL), ('setting', NEW.chat_id, NEW.name, NEW.value); END;
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self._db = None
+
+    def open(self):
+        self._db = open_db(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA synchronous=FULL")
+        with self._db:
+            self._db.executescript(
+                "CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY);"
+                "CREATE TABLE IF NOT EXISTS groups (chat_id INTEGER PRIMARY KEY);"
+                "CREATE TABLE IF NOT EXISTS authorizations ("
+                "chat_id INTEGER NOT NULL, user_id INTEGER NOT NULL, PRIMARY KEY (chat_id, user_id));"
+                "CREATE TABLE IF NOT EXISTS group_settings ("
+                "chat_id INTEGER NOT NULL, name TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (chat_id, name));"
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);"
+                + self.CHANGE_LOG_SCHEMA
+            )
 
-# Initialize data
-data = load_data()
-started_users = set(data.get("started_users", []))
-group_ids = set(data.get("group_ids", []))
-authorized_users = data.get("authorized_users", [])
-authorized_user_ids = set(data.get("authorized_user_ids", []))
-global_authorized_users = set(data.get("global_authorized_users", []))
-group_authorized_users = {k: set(v) for k, v in data.get("group_authorized_users", {}).items()}
-group_settings = data.get("group_settings", {})
+    # Changes committed by other connections since the last call bump this number
+    def data_version(self):
+        with self.lock:
+            return self._db.execute("PRAGMA data_version").fetchone()[0]
+
+    # Id of the newest logged change, 0 if there is none
+    def last_change(self):
+        with self.lock:
+            row = self._db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'state_changes'").fetchone()
+        return row[0] if row else 0
+
+    # [(id, key, value)] logged after `change_id`, or None if some of them were already pruned
+    def changes_since(self, change_id):
+        with self.lock:
+            rows = self._db.execute(
+                "SELECT id, kind, chat_id, item, value FROM state_changes WHERE id > ? ORDER BY id", (change_id,)
+            ).fetchall()
+        if not rows:
+            return [] if self.last_change() <= change_id else None
+        if rows[0][0] != change_id + 1:
+            return None
+        changes = []
+        for row_id, kind, chat_id, item, value in rows:
+            key = (kind, item) if chat_id is None else (kind, chat_id, item)
+            changes.append((row_id, key, None if value is None else json.loads(value)))
+        return changes
+
+    # One-shot import of the data.json layout; returns False if already done or nothing to import
+    def migrate_from_json(self, json_path):
+        # Shards start together: the check, the import and the marker form one write transaction
+        with self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            if self._db.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+                return False
+            try:
+                with open(json_path, "r") as file:
+                    content = file.read().strip()
+            except FileNotFoundError:
+                return False
+            data = json.loads(content) if content else {}
+
+            global_id = self.GLOBAL_CHAT_ID
+            self._db.executemany("INSERT OR IGNORE INTO users VALUES (?)", [(u,) for u in data.get("started_users", [])])
+            self._db.executemany("INSERT OR IGNORE INTO groups VALUES (?)", [(g,) for g in data.get("group_ids", [])])
+            self._db.executemany(
+                "INSERT OR IGNORE INTO authorizations VALUES (?, ?)",
+                [(global_id, u) for u in data.get("global_authorized_users", [])]
+                + [(int(c), u) for c, users in data.get("group_authorized_users", {}).items() for u in users],
+            )
+            self._db.executemany(
+                "INSERT OR REPLACE INTO group_settings VALUES (?, ?, ?)",
+                [(int(c), name, json.dumps(value)) for c, settings in data.get("group_settings", {}).items()
+                 for name, value in settings.items()],
+            )
+            self._db.execute("INSERT OR IGNORE INTO meta VALUES ('json_migrated', ?)", (str(time.time()),))
+        return True
 
-save_data()  # Save data after initializing
+    def load(self):
+        with self.lock:
+            return self._load()
+
+    def _load(self):
+        db = self._db
+        global_users = set()
+        group_users = {}
+        for chat_id, user_id in db.execute("SELECT chat_id, user_id FROM authorizations"):
+            if chat_id == self.GLOBAL_CHAT_ID:
+                global_users.add(user_id)
+            else:
+                group_users.setdefault(chat_id, []).append(user_id)
+        settings = {}
+        for chat_id, name, value in db.execute("SELECT chat_id, name, value FROM group_settings"):
+            settings.setdefault(chat_id, {})[name] = json.loads(value)
+        return {
+            "started_users": IdSet.from_sorted(row[0] for row in db.execute("SELECT user_id FROM users ORDER BY user_id")),
+            "group_ids": IdSet.from_sorted(row[0] for row in db.execute("SELECT chat_id FROM groups ORDER BY chat_id")),
+            "global_authorized_users": global_users,
+            "group_authorized_users": {chat_id: set(users) for chat_id, users in group_users.items()},
+            "group_settings": settings,
+        }
+
+    # Commit a batch of coalesced row changes (see StateWriter) in one transaction
+    def write_changes(self, changes):
+        rows = {}  # statement -> parameters
+        for key, value in changes.items():
+            if key[0] == "setting":
+                rows.setdefault(self.SETTING_STATEMENT, []).append((key[1], key[2], json.dumps(value)))
+            else:
+                rows.setdefault(self.ROW_STATEMENTS[key[0]][value], []).append(key[1:])
+        started = time.perf_counter()
+        with self.lock, self._db:
+            for statement, params in rows.items():
+                self._db.executemany(statement, params)
+            self._db.execute(
+                "DELETE FROM state_changes WHERE id <= (SELECT max(id) FROM state_changes) - ?", (STATE_CHANGES_KEEP,)
+            )
+        STORAGE_WRITES.inc("flush")
+        STORAGE_WRITE_LATENCY.observe(time.perf_counter() - started)
+
+
+# Write-behind persistence for BotState
+class StateWriter:
+    """Coalesces state changes and commits them off the event loop.
+
+    Changes are keyed by the row they touch, so a row changed several times
+    between flushes is written once, with its last value. Dirty rows are
+    committed in one transaction at most every `interval` seconds (sooner
+    once `batch_size` rows are dirty) on a single writer thread, so command
+    handlers never wait on SQLite or fsync.
+
+    Keys are ("user", user_id), ("group", chat_id) and
+    ("auth", chat_id, user_id), mapping to True (row present) or False (row
+    absent), and ("setting", chat_id, name), mapping to the setting's value.
+    """
+
+    def __init__(self, storage, interval=STATE_FLUSH_INTERVAL, batch_size=STATE_FLUSH_BATCH):
+        self.storage = storage
+        self.interval = interval
+        self.batch_size = batch_size
+        self.dirty = {}
+        self.in_flight = {}  # Batch the writer thread is committing
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-writer")
+        self._flush_now = asyncio.Event()
+
+    def __len__(self):
+        return len(self.dirty)
+
+    def set(self, key, value):
+        self.dirty[key] = value
+        if len(self.dirty) >= self.batch_size:
+            self._flush_now.set()
+
+    # Changes not committed yet, oldest first
+    def pending(self):
+        return itertools.chain(self.in_flight.items(), self.dirty.items())
+
+    # Run a storage call on the writer thread, after any commit in progress
+    async def run_in_thread(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        self.in_flight, self.dirty = self.dirty, {}
+        try:
+            await self.run_in_thread(self.storage.write_changes, self.in_flight)
+        except Exception as e:
+            # Retry with the next flush; newer changes to the same rows win
+            self.dirty = {**self.in_flight, **self.dirty}
+            logger.error(f"Failed to write {len(self.in_flight)} state changes: {e}")
+        finally:
+            self.in_flight = {}
+
+    # Wait for the writer thread, then commit whatever is still dirty
+    def close(self):
+        self._executor.shutdown(wait=True)
+        if self.dirty:
+            self.storage.write_changes(self.dirty)
+            self.dirty = {}
+
+    async def run(self):
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._flush_now.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._flush_now.clear()
+                await self.flush()
+        finally:
+            self.close()
+
+
+# In-memory bot state; the database is only the persistence backing of this object
+class BotState:
+    """Authoritative copy of users, groups, authorizations and group settings.
+
+    Reads never touch the database. Every change is applied in memory at
+    once and handed to `writer`, which persists it shortly afterwards. The
+    large user and group id collections are IdSets; authorized users stay in
+    plain sets, which are small and checked on every group message.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.writer = StateWriter(storage)
+        self.started_users = IdSet()
+        self.group_ids = IdSet()
+        self.global_authorized_users = set()
+        self.group_authorized_users = {}
+        self.group_settings = {}
+        self._policies = {}  # chat_id -> GroupPolicy compiled from group_settings
+        self._data_version = None
+        self._change_id = 0  # Newest state_changes row applied
+
+    def _apply(self, data):
+        self.started_users = data["started_users"]
+        self.group_ids = data["group_ids"]
+        self.global_authorized_users = data["global_authorized_users"]
+        self.group_authorized_users = data["group_authorized_users"]
+        self.group_settings = data["group_settings"]
+        self._policies = {}
+
+    # Apply (key, value) row changes on top of loaded state, e.g. ones the writer has not committed
+    def _replay(self, changes):
+        for key, value in changes:
+            kind = key[0]
+            if kind == "setting":
+                if value is None:
+                    self.group_settings.get(key[1], {}).pop(key[2], None)
+                else:
+                    self.group_settings.setdefault(key[1], {})[key[2]] = value
+                self._policies.pop(key[1], None)
+                continue
+            if kind == "user":
+                ids = self.started_users
+            elif kind == "group":
+                ids = self.group_ids
+            elif key[1] == Storage.GLOBAL_CHAT_ID:
+                ids = self.global_authorized_users
+            else:
+                ids = self.group_authorized_users.setdefault(key[1], set())
+            (ids.add if value else ids.discard)(key[-1])
+
+    # Load state from the database, importing data.json on first run; safe to run on a thread
+    def load(self):
+        self.storage.open()
+        if self.storage.migrate_from_json(DATA_FILE):
+            logger.info(f"Imported {DATA_FILE} into {self.storage.path}.")
+        # Changes logged while loading are applied again by watch(), which is harmless
+        self._change_id = self.storage.last_change()
+        self._apply(self.storage.load())
+        # Changes made before the load (e.g. by a benchmark) are still waiting in the writer
+        self._replay(self.writer.pending())
+        self._data_version = self.storage.data_version()
+
+    # Apply the rows another connection (a shard, the sqlite3 shell) changed in the database
+    async def watch(self, interval=DATA_RELOAD_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            data_version = await self.writer.run_in_thread(self.storage.data_version)
+            if data_version == self._data_version:
+                continue
+            self._data_version = data_version
+            changes = await self.writer.run_in_thread(self.storage.changes_since, self._change_id)
+            if changes is None:
+                # Too far behind for the change log; start over from the tables
+                self._change_id = await self.writer.run_in_thread(self.storage.last_change)
+                self._apply(await self.writer.run_in_thread(self.storage.load))
+                logger.info(f"Reloaded state after external changes to {self.storage.path}.")
+            elif changes:
+                self._change_id = changes[-1][0]
+                self._replay((key, value) for _, key, value in changes)
+            else:
+                continue
+            self._replay(self.writer.pending())
+
+    def is_exempt(self, user_id, chat_id):
+        if user_id in self.global_authorized_users:
+            return True
+        group_users = self.group_authorized_users.get(chat_id)
+        return group_users is not None and user_id in group_users
+
+    def get_group_settings(self, chat_id):
+        return self.group_settings.get(chat_id, {})
+
+    # Compiled deletion policy of a chat, rebuilt only after its settings change
+    def policy(self, chat_id):
+        policy = self._policies.get(chat_id)
+        if policy is None:
+            settings = self.group_settings.get(chat_id)
+            if settings is None:
+                return NO_POLICY
+            policy = self._policies[chat_id] = GroupPolicy(settings)
+        return policy
+
+    def update_group_settings(self, chat_id, **values):
+        self.group_settings.setdefault(chat_id, {}).update(values)
+        self._policies.pop(chat_id, None)
+        for name, value in values.items():
+            self.writer.set(("setting", chat_id, name), value)
+
+    # Returns False if the user was already authorized
+    def authorize(self, user_id, chat_id=None):
+        users = self.global_authorized_users if chat_id is None else self.group_authorized_users.setdefault(chat_id, set())
+        if user_id in users:
+            return False
+        users.add(user_id)
+        self.writer.set(("auth", Storage.GLOBAL_CHAT_ID if chat_id is None else chat_id, user_id), True)
+        return True
 
-# Set timer for auto-delete
-async def set_timer(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.message.from_user.id
-    chat_id = update.message.chat.id
+    # Returns False if the user was not authorized
+    def unauthorize(self, user_id, chat_id=None):
+        users = self.global_authorized_users if chat_id is None else self.group_authorized_users.get(chat_id, set())
+        if user_id not in users:
+            return False
+        users.discard(user_id)
+        self.writer.set(("auth", Storage.GLOBAL_CHAT_ID if chat_id is None else chat_id, user_id), False)
+        return True
 
-    # Check if the user is an admin or owner
-    if not await is_admin_or_owner(user_id, chat_id, context.bot):
-        await update.message.reply_text("Only group admins or the owner can set the auto-delete timer.")
-        return
 
-    # Ensure a timer value is provided
-    if len(context.args) != 1:
-        await update.message.reply_text("Usage: /settimer <time_in_minutes> (e.g., /settimer 30)")
-        return
+# Loaded in post_init, once the Application exists
+state = BotState(Storage(DB_FILE))
+
+
+# Users who can be messaged and groups the bot is in, as seen in live traffic
+class Registry:
+    """Keeps state.started_users and state.group_ids current.
+
+    Changes are applied to the in-memory sets at once, so the message path
+    only pays for a set lookup; the rows are persisted by state.writer.
+    """
+
+    def __init__(self, state):
+        self.state = state
+
+    def add_user(self, user_id):
+        if user_id not in self.state.started_users:
+            self.state.started_users.add(user_id)
+            self.state.writer.set(("user", user_id), True)
+
+    def remove_user(self, user_id):
+        if user_id in self.state.started_users:
+            self.state.started_users.discard(user_id)
+            self.state.writer.set(("user", user_id), False)
+
+    def add_group(self, chat_id):
+        if chat_id not in self.state.group_ids:
+            self.state.group_ids.add(chat_id)
+            self.state.writer.set(("group", chat_id), True)
+
+    def remove_group(self, chat_id):
+        if chat_id in self.state.group_ids:
+            self.state.group_ids.discard(chat_id)
+            self.state.writer.set(("group", chat_id), False)
+
+    # Record the private chat or group a message or membership change came from
+    def see_chat(self, chat):
+        if chat.type == "private":
+            self.add_user(chat.id)
+        elif chat.type in ("group", "supergroup"):
+            self.add_group(chat.id)
+
+    # The bot was removed from a group, or blocked by a user. Legacy data.json group_ids
+    # hold user ids too, so the id is removed from both sets whatever its sign
+    def remove_chat(self, chat_id):
+        self.remove_user(chat_id)
+        self.remove_group(chat_id)
+
+
+registry = Registry(state)
+metrics.callback("bot_state_dirty_rows", "State rows changed but not yet written.", "gauge", lambda: len(state.writer))
+metrics.callback("bot_users", "Users who can receive broadcasts.", "gauge", lambda: len(state.started_users))
+metrics.callback("bot_groups", "Groups the bot is in.", "gauge", lambda: len(state.group_ids))
+
+
+# Copy a SQLite database into `directory` as <name>-<timestamp>.db, keeping the newest `keep` copies
+def snapshot_database(db_path, directory=SNAPSHOT_DIR, keep=SNAPSHOT_KEEP):
+    """Consistent online copy made with the SQLite backup API.
+
+    The copy is written to a temporary file, fsynced and renamed into place,
+    so a snapshot that exists is always complete. To recover, stop the bot
+    and copy a snapshot over the database (removing its -wal and -shm files).
+    """
+    os.makedirs(directory, exist_ok=True)
+    name = os.path.splitext(os.path.basename(db_path))[0]
+    final_path = os.path.join(directory, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.db")
+    temp_path = final_path + ".tmp"
+    source = sqlite3.connect(db_path)
+    target = sqlite3.connect(temp_path)
     try:
-        timer_minutes = int(context.args[0])
-        if timer_minutes <= 0:
-            raise ValueError
-    except ValueError:
-        await update.message.reply_text("Please provide a valid positive integer for the time in minutes.")
-        return
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+    with open(temp_path, "rb") as file:
+        os.fsync(file.fileno())
+    os.replace(temp_path, final_path)
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    snapshots = sorted(f for f in os.listdir(directory) if f.startswith(f"{name}-") and f.endswith(".db"))
+    for old in snapshots[:-keep]:
+        os.remove(os.path.join(directory, old))
+    return final_path
+
+
+# Snapshot the state databases at startup and every `interval` seconds, off the event loop
+async def snapshot_loop(paths=(DB_FILE, MEDIA_DB_FILE), interval=SNAPSHOT_INTERVAL):
+    loop = asyncio.get_running_loop()
+    while True:
+        for path in paths:
+            try:
+                snapshot_path = await loop.run_in_executor(None, snapshot_database, path)
+                logger.info(f"Snapshot of {path} written to {snapshot_path}.")
+            except Exception as e:
+                logger.error(f"Failed to snapshot {path}: {e}")
+        await asyncio.sleep(interval)
+
+
+# Single timer heap for all pending message deletions
+class DeletionScheduler:
+    """Deletes messages when they expire, surviving restarts.
+
+    Every pending deletion is a compact (due_ts, chat_id, message_id) tuple in
+    one heap driven by a single task, instead of a sleeping coroutine per
+    message. Entries are journaled to the pending_deletions table in batches,
+    and overdue entries found at startup are deleted right away.
+
+    Due messages are collected per chat and removed every flush_interval
+    seconds with bulk deleteMessages calls of up to DELETE_BATCH_SIZE ids.
+
+    drop_chat() cancels a chat's pending deletions in O(1) by leaving a
+    tombstone: the highest message id pending for the chat at that point.
+    Heap entries at or below it are skipped without an API call when they
+    fall due. Message ids only grow within a chat, so later deletions for
+    the chat are unaffected; one scheduled below a live tombstone (e.g. a
+    flagged old message) first purges the chat's dead entries from the heap.
+
+    A message has at most one live entry. Scheduling it again sooner (e.g.
+    deleting an edited message whose timer is still running) supersedes the
+    old entry, which is skipped when it comes up; scheduling it later is
+    ignored.
+    """
+
+    def __init__(self, db_path, flush_interval=DELETE_FLUSH_INTERVAL):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.api_calls = 0
+        self.messages_deleted = 0
+        self.messages_skipped = 0
+        self.failed_calls = 0
+        self._heap = []
+        self._chats = {}  # chat_id -> [{message_id: due_ts} of live entries, highest message id among them]
+        self._tombstones = {}  # chat_id -> [highest dropped message id, dropped entries still in the heap]
+        self._dead = 0  # Dropped entries still in the heap
+        self._superseded = set()  # Heap entries replaced by a sooner one for the same message
+        self._journal_added = []
+        self._journal_removed = []
+        self._journal_dropped = []
+        self._db = None
+        self._bot = None
+
+    # Live deletions only; dropped and superseded entries waiting to be skipped are not counted
+    def __len__(self):
+        return len(self._heap) - self._dead - len(self._superseded)
+
+    # API calls avoided compared to one deleteMessage call per message
+    @property
+    def calls_saved(self):
+        return self.messages_deleted - self.api_calls
+
+    # Load the journal and start the deletion loop
+    def start(self, bot, shard=None):
+        self._bot = bot
+        self.load(shard)
+        return asyncio.create_task(self.run())
+
+    # Read pending deletions into the heap; `shard` is (index, count) in supervisor mode
+    def load(self, shard=None):
+        self._db = open_db(self.db_path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS pending_deletions ("
+            "chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, due_ts REAL NOT NULL, "
+            "PRIMARY KEY (chat_id, message_id))"
+        )
+        if shard is None:
+            self._heap = self._db.execute("SELECT due_ts, chat_id, message_id FROM pending_deletions").fetchall()
+        else:
+            self._heap = self._db.execute(
+                "SELECT due_ts, chat_id, message_id FROM pending_deletions WHERE abs(chat_id) % ? = ?",
+                (shard[1], shard[0]),
+            ).fetchall()
+        heapq.heapify(self._heap)
+        for due_ts, chat_id, message_id in self._heap:
+            self._count(due_ts, chat_id, message_id)
+        overdue = sum(1 for due_ts, _, _ in self._heap if due_ts <= time.time())
+        logger.info(f"Loaded {len(self._heap)} pending deletions ({overdue} overdue).")
+
+    def _count(self, due_ts, chat_id, message_id):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            self._chats[chat_id] = [{message_id: due_ts}, message_id]
+        else:
+            chat[0][message_id] = due_ts
+            if message_id > chat[1]:
+                chat[1] = message_id
+
+    def schedule(self, chat_id, message_id, delay):
+        tombstone = self._tombstones.get(chat_id)
+        if tombstone is not None and message_id <= tombstone[0]:
+            self._purge(chat_id)
+        entry = (time.time() + delay, chat_id, message_id)
+        chat = self._chats.get(chat_id)
+        current = chat[0].get(message_id) if chat else None
+        if current is not None:
+            if current <= entry[0]:
+                return
+            self._superseded.add((current, chat_id, message_id))
+        heapq.heappush(self._heap, entry)
+        self._count(*entry)
+        # INSERT OR REPLACE, so a superseded row just gets the sooner due time
+        self._journal_added.append(entry)
+        if current is None:
+            DELETIONS_SCHEDULED.inc()
+
+    # Cancel every deletion pending for a chat; returns how many were cancelled
+    def drop_chat(self, chat_id):
+        chat = self._chats.pop(chat_id, None)
+        if chat is None:
+            return 0
+        count, highest = len(chat[0]), chat[1]
+        tombstone = self._tombstones.get(chat_id)
+        if tombstone is None:
+            self._tombstones[chat_id] = [highest, count]
+        else:
+            tombstone[0] = max(tombstone[0], highest)
+            tombstone[1] += count
+        self._dead += count
+        self.messages_skipped += count
+        # Rows not journaled yet are simply not written; the flush deletes the rest before any
+        # later insert, so a deletion scheduled below the tombstone afterwards is kept
+        self._journal_added = [entry for entry in self._journal_added if entry[1] != chat_id]
+        self._journal_dropped.append((chat_id, highest))
+        return count
+
+    # Remove a chat's dropped entries from the heap right away
+    def _purge(self, chat_id):
+        highest, count = self._tombstones.pop(chat_id)
+        kept = []
+        for entry in self._heap:
+            if entry[1] == chat_id and entry[2] <= highest:
+                self._superseded.discard(entry)
+            else:
+                kept.append(entry)
+        self._heap = kept
+        heapq.heapify(self._heap)
+        self._dead -= count
+
+    def _flush_journal(self):
+        if not self._journal_added and not self._journal_removed and not self._journal_dropped:
+            return
+        with self._db:
+            self._db.executemany(
+                "DELETE FROM pending_deletions WHERE chat_id = ? AND message_id <= ?",
+                self._journal_dropped,
+            )
+            self._db.executemany(
+                "INSERT OR REPLACE INTO pending_deletions (due_ts, chat_id, message_id) VALUES (?, ?, ?)",
+                self._journal_added,
+            )
+            self._db.executemany(
+                "DELETE FROM pending_deletions WHERE chat_id = ? AND message_id = ?",
+                self._journal_removed,
+            )
+        self._journal_added.clear()
+        self._journal_removed.clear()
+        self._journal_dropped.clear()
+
+    def _pop_due(self):
+        due = {}
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            if self._superseded and entry in self._superseded:
+                self._superseded.discard(entry)
+                continue
+            due_ts, chat_id, message_id = entry
+            tombstone = self._tombstones.get(chat_id)
+            if tombstone is not None and message_id <= tombstone[0]:
+                # Dropped; already counted as skipped and removed from the journal
+                self._dead -= 1
+                tombstone[1] -= 1
+                if not tombstone[1]:
+                    del self._tombstones[chat_id]
+                continue
+            chat = self._chats[chat_id]
+            del chat[0][message_id]
+            if not chat[0]:
+                del self._chats[chat_id]
+            due.setdefault(chat_id, []).append(message_id)
+            DELETION_LAG.observe(now - due_ts)
+        return due
+
+    # Returns False if the bot can no longer act in the chat
+    async def _delete_batch(self, chat_id, message_ids):
+        self.api_calls += 1
+        self._journal_removed.extend((chat_id, message_id) for message_id in message_ids)
+        try:
+            await self._bot.delete_messages(
+                chat_id=chat_id, message_ids=message_ids, rate_limit_args=LANE_DELETION
+            )
+            self.messages_deleted += len(message_ids)
+        except (Forbidden, BadRequest) as e:
+            self.failed_calls += 1
+            if isinstance(e, BadRequest) and "chat not found" not in str(e).lower():
+                logger.info(f"Failed to delete {len(message_ids)} messages in {chat_id}: {e}")
+                return True
+            # Removed from the chat: nothing else pending there can be deleted either
+            registry.remove_chat(chat_id)
+            skipped = self.drop_chat(chat_id)
+            logger.info(f"Cannot delete in {chat_id} any more ({e}); dropped {skipped} pending deletions.")
+            return False
+        except Exception as e:
+            self.failed_calls += 1
+            logger.info(f"Failed to delete {len(message_ids)} messages in {chat_id}: {e}")
+        return True
+
+    async def run(self):
+        try:
+            while True:
+                for chat_id, message_ids in self._pop_due().items():
+                    for i in range(0, len(message_ids), DELETE_BATCH_SIZE):
+                        if not await self._delete_batch(chat_id, message_ids[i:i + DELETE_BATCH_SIZE]):
+                            rest = message_ids[i + DELETE_BATCH_SIZE:]
+                            self.messages_skipped += len(rest)
+                            self._journal_removed.extend((chat_id, message_id) for message_id in rest)
+                            break
+                self._flush_journal()
+                await asyncio.sleep(self.flush_interval)
+        finally:
+            self._flush_journal()
+            self._db.close()
+            logger.info(
+                f"Deletion scheduler stopped: {self.messages_deleted} messages deleted in "
+                f"{self.api_calls} calls ({self.calls_saved} calls saved, {self.failed_calls} failed), "
+                f"{self.messages_skipped} skipped."
+            )
+
+
+deletion_scheduler = DeletionScheduler(JOURNAL_DB_FILE)
+metrics.callback("bot_deletions_pending", "Deletions waiting for their due time.", "gauge", lambda: len(deletion_scheduler))
+metrics.callback("bot_deletions_executed_total", "Messages deleted by the scheduler.", "counter", lambda: deletion_scheduler.messages_deleted)
+metrics.callback("bot_deletions_skipped_total", "Pending deletions dropped because the chat no longer needs them.", "counter", lambda: deletion_scheduler.messages_skipped)
+metrics.callback("bot_deletion_calls_total", "deleteMessages calls made.", "counter", lambda: deletion_scheduler.api_calls)
+metrics.callback("bot_deletion_failed_calls_total", "deleteMessages calls that failed.", "counter", lambda: deletion_scheduler.failed_calls)
+
+
+# Fixed-size Bloom filter over strings; false positives possible, false negatives not
+class BloomFilter:
+    def __init__(self, capacity, error_rate=BLOOM_ERROR_RATE):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    # Double hashing: the k bit positions come from the two halves of one 128-bit digest
+    @staticmethod
+    def _hash(key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+
+    def add(self, key):
+        h1, h2 = self._hash(key)
+        for i in range(self.hashes):
+            position = (h1 + i * h2) % self.size
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    # Stops at the first unset bit, which is where most misses end
+    def __contains__(self, key):
+        h1, h2 = self._hash(key)
+        bits, size = self.bits, self.size
+        for i in range(self.hashes):
+            position = (h1 + i * h2) % size
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+# Known-bad media, matched by file_unique_id and optionally by perceptual hash
+class MediaIndex:
+    """Flagged media ids in the flagged_media table of MEDIA_DB_FILE.
+
+    Flags with chat_id 0 (from the owner or the blocklist file) apply in
+    every group; flags set by a group's admins only apply in that group.
+    A Bloom filter of all flagged ids is kept in memory, so checking a media
+    message that was never flagged does no I/O; only filter hits are
+    confirmed against the table. The filter is rebuilt when the database is
+    changed by another process or the blocklist file changes.
+    """
+
+    GLOBAL_CHAT_ID = 0
+
+    def __init__(self, db_path, blocklist_path=MEDIA_BLOCKLIST_FILE):
+        self.db_path = db_path
+        self.blocklist_path = blocklist_path
+        self.bloom = BloomFilter(BLOOM_MIN_CAPACITY)
+        self.count = 0
+        self.phashes = []  # (hash, chat_id) of flagged photos
+        self._db = None
+        self._data_version = None
+        self._blocklist_mtime = None
+
+    def open(self):
+        self._db = open_db(self.db_path)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS flagged_media ("
+                "file_unique_id TEXT NOT NULL, chat_id INTEGER NOT NULL, flagged_by INTEGER, "
+                "source TEXT NOT NULL, phash TEXT, flagged_ts REAL NOT NULL, "
+                "PRIMARY KEY (file_unique_id, chat_id))"
+            )
+        self.import_blocklist()
+        self._rebuild()
+        logger.info(f"Loaded {self.count} flagged media ids.")
+
+    # Add the ids listed in the blocklist file (one per line, # comments) as global flags; True if it was read
+    def import_blocklist(self):
+        try:
+            mtime = os.stat(self.blocklist_path).st_mtime
+        except FileNotFoundError:
+            return False
+        if mtime == self._blocklist_mtime:
+            return False
+        self._blocklist_mtime = mtime
+        with open(self.blocklist_path) as file:
+            ids = {line.split("#", 1)[0].strip() for line in file} - {""}
+        with self._db:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO flagged_media (file_unique_id, chat_id, source, flagged_ts) "
+                "VALUES (?, ?, 'blocklist', ?)",
+                [(file_unique_id, self.GLOBAL_CHAT_ID, time.time()) for file_unique_id in ids],
+            )
+        logger.info(f"Imported {len(ids)} ids from {self.blocklist_path}.")
+        return True
+
+    def _rebuild(self):
+        rows = self._db.execute("SELECT file_unique_id, chat_id, phash FROM flagged_media").fetchall()
+        bloom = BloomFilter(max(BLOOM_MIN_CAPACITY, 2 * len(rows)))
+        for file_unique_id, _, _ in rows:
+            bloom.add(file_unique_id)
+        self.bloom = bloom
+        self.count = len(rows)
+        self.phashes = [(int(phash, 16), chat_id) for _, chat_id, phash in rows if phash]
+        self._data_version = self._db.execute("PRAGMA data_version").fetchone()[0]
+
+    def is_flagged(self, file_unique_id, chat_id):
+        if not self.count or file_unique_id not in self.bloom:
+            return False
+        return self._db.execute(
+            "SELECT 1 FROM flagged_media WHERE file_unique_id = ? AND chat_id IN (?, ?)",
+            (file_unique_id, self.GLOBAL_CHAT_ID, chat_id),
+        ).fetchone() is not None
+
+    def flag(self, file_unique_id, chat_id, user_id, source="admin"):
+        with self._db:
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO flagged_media (file_unique_id, chat_id, flagged_by, source, flagged_ts) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (file_unique_id, chat_id, user_id, source, time.time()),
+            )
+        self.bloom.add(file_unique_id)
+        self.count += cursor.rowcount
+        if self.count > self.bloom.capacity:
+            self._rebuild()
+
+    # Returns False if the id was not flagged for this scope
+    def unflag(self, file_unique_id, chat_id):
+        with self._db:
+            cursor = self._db.execute(
+                "DELETE FROM flagged_media WHERE file_unique_id = ? AND chat_id = ?", (file_unique_id, chat_id)
+            )
+        if cursor.rowcount:
+            # Bloom filters cannot forget, so start from the table again
+            self._rebuild()
+        return cursor.rowcount > 0
+
+    def set_phash(self, file_unique_id, chat_id, phash):
+        with self._db:
+            self._db.execute(
+                "UPDATE flagged_media SET phash = ? WHERE file_unique_id = ? AND chat_id = ?",
+                (f"{phash:016x}", file_unique_id, chat_id),
+            )
+        self.phashes.append((phash, chat_id))
+
+    def matches_phash(self, phash, chat_id):
+        return any(
+            flagged_chat in (self.GLOBAL_CHAT_ID, chat_id) and (phash ^ flagged).bit_count() <= PHASH_MAX_DISTANCE
+            for flagged, flagged_chat in self.phashes
+        )
+
+    # Pick up flags written by other shards or an edited blocklist file
+    async def watch(self, interval=DATA_RELOAD_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            imported = self.import_blocklist()
+            if imported or self._db.execute("PRAGMA data_version").fetchone()[0] != self._data_version:
+                self._rebuild()
+
+
+media_index = MediaIndex(MEDIA_DB_FILE)
+metrics.callback("bot_flagged_media", "Flagged media ids in the index.", "gauge", lambda: media_index.count)
+
+
+# 64-bit difference hash of an image: robust to re-encoding and resizing. Runs in the process pool.
+def photo_dhash(data):
+    image = Image.open(io.BytesIO(data)).convert("L").resize((9, 8))
+    pixels = list(image.getdata())
+    phash = 0
+    for row in range(8):
+        for col in range(8):
+            phash = phash << 1 | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return phash
+
+
+class PhotoHasher:
+    """Finds re-uploads of flagged photos by perceptual hash.
+
+    Each incoming photo's smallest thumbnail is downloaded and hashed in a
+    process pool in the background, so the message path never waits on it.
+    Photos within PHASH_MAX_DISTANCE bits of a flagged photo are deleted.
+    When PHASH_MAX_PENDING checks are already running, new photos are
+    skipped instead of queued.
+    """
+
+    def __init__(self, workers=PHASH_WORKERS):
+        self.workers = workers
+        self._pool = None
+        self._pending = 0
+
+    async def _hash(self, bot, photo_size):
+        file = await bot.get_file(photo_size.file_id, rate_limit_args=LANE_BACKGROUND)
+        data = await file.download_as_bytearray()
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return await asyncio.get_running_loop().run_in_executor(self._pool, photo_dhash, bytes(data))
+
+    def _spawn(self, coroutine):
+        if self._pending >= PHASH_MAX_PENDING:
+            coroutine.close()
+            PHASH_CHECKS.inc("skipped")
+            return
+        self._pending += 1
+        task = asyncio.create_task(coroutine)
+        background_tasks.add(task)
+        task.add_done_callback(self._done)
+
+    def _done(self, task):
+        self._pending -= 1
+        background_tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            PHASH_CHECKS.inc("failed")
+            logger.info(f"Photo hashing failed: {task.exception()}")
+
+    async def _check(self, bot, message):
+        phash = await self._hash(bot, message.photo[0])
+        if media_index.matches_phash(phash, message.chat.id):
+            PHASH_CHECKS.inc("matched")
+            deletion_scheduler.schedule(message.chat.id, message.message_id, 0)
+        else:
+            PHASH_CHECKS.inc("clean")
+
+    async def _remember(self, bot, message, chat_id):
+        phash = await self._hash(bot, message.photo[0])
+        media_index.set_phash(message.photo[-1].file_unique_id, chat_id, phash)
+
+    # Compare a newly posted photo against the flagged ones; nothing to download while none are
+    def check(self, bot, message):
+        if not media_index.phashes:
+            return
+        self._spawn(self._check(bot, message))
+
+    # Store the hash of a photo that was just flagged for `chat_id`
+    def remember(self, bot, message, chat_id):
+        self._spawn(self._remember(bot, message, chat_id))
+
+    def shutdown(self):
+        if self._pool:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+if PHASH_WORKERS and Image is None:
+    logger.warning("PHASH_WORKERS is set but Pillow is not installed; perceptual hashing is disabled.")
+photo_hasher = PhotoHasher() if PHASH_WORKERS and Image is not None else None
+
+
+# Async token bucket shared by everything that must respect a send rate
+class TokenBucket:
+    """Allows `rate` acquisitions per second with bursts of up to `capacity`.
+
+    Waiters are served lowest `priority` first, and in arrival order within
+    the same priority.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._waiters = []  # heap of (priority, sequence, future)
+        self._sequence = 0
+        self._dispatcher = None
+
+    # Stop handing out tokens for a while, e.g. after Telegram answers with RetryAfter
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        # Refill from the end of the pause instead of bursting the moment it ends
+        self._tokens = 0
+        self._updated = self._paused_until
+
+    def paused_for(self):
+        return max(0.0, self._paused_until - time.monotonic())
+
+    # Take a token without waiting, borrowing against the refill when none is left, so a
+    # caller that cannot wait still slows down the ones queued behind the bucket
+    def charge(self):
+        now = time.monotonic()
+        if now > self._updated:  # During a pause _updated is its end
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+        self._tokens = max(self._tokens - 1, -self.capacity)
+
+    def _take(self):
+        now = time.monotonic()
+        if now < self._paused_until:
+            return False
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    async def _dispatch(self):
+        while self._waiters:
+            future = self._waiters[0][2]
+            if future.done():  # the waiter was cancelled
+                heapq.heappop(self._waiters)
+            elif self._take():
+                heapq.heappop(self._waiters)
+                future.set_result(None)
+            else:
+                now = time.monotonic()
+                await asyncio.sleep(max(self._paused_until - now, (1 - self._tokens) / self.rate))
+
+    async def acquire(self, priority=0):
+        if not self._waiters and self._take():
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._sequence += 1
+        heapq.heappush(self._waiters, (priority, self._sequence, future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+
+# RetryAfter.retry_after is an int in older releases and a timedelta in newer ones
+def retry_after_seconds(error):
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else retry_after
+
+
+# Priority lanes for outgoing Bot API calls, passed as `rate_limit_args`
+LANE_INTERACTIVE = 0  # Replies to commands and other user-facing calls (the default)
+LANE_DELETION = 1  # Scheduled deletions
+LANE_BACKGROUND = 2  # Broadcasts and group scans
+LANE_NAMES = ("interactive", "deletion", "background")
+
+# Methods limited per chat by Telegram, and methods that must not be repeated after a timeout
+CHAT_LIMITED_PREFIXES = ("send", "copy", "forward", "edit")
+NON_IDEMPOTENT_PREFIXES = ("send", "copy", "forward")
+# Read-only methods whose identical concurrent calls share one request
+COALESCED_METHODS = frozenset({"getMe", "getChat", "getChatAdministrators", "getChatMember", "getChatMemberCount"})
+
+
+# The single outbound path for every Bot API call except getUpdates
+class ApiRateLimiter(BaseRateLimiter):
+    """Keeps the bot under Telegram's limits and retries transient failures.
+
+    Every call takes a token from a global bucket; sends and edits also take
+    one from their chat's bucket (1/s for private chats, 20/min for groups).
+    Waiting calls are served by lane, so command replies overtake queued
+    deletions and broadcasts. RetryAfter pauses the chat's bucket for sends
+    and edits, and the global bucket otherwise, for the requested time plus
+    jitter before the call is retried; network errors are retried with
+    jittered exponential backoff, except timeouts on sends, which may already
+    have been delivered.
+
+    Interactive calls run inside their chat's ordered update worker, so they
+    never wait on the chat bucket: they charge it without waiting, and a
+    paused chat fails them at once with RetryAfter instead of holding up
+    every later update of the chat.
+    """
+
+    def __init__(self, rate=BOT_API_RATE, max_retries=API_MAX_RETRIES):
+        self.bucket = TokenBucket(rate)
+        self.max_retries = max_retries
+        self._chat_buckets = OrderedDict()
+        self._in_flight = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(PRIVATE_CHAT_RATE)
+            else:
+                bucket = TokenBucket(GROUP_CHAT_RATE, GROUP_CHAT_BURST)
+            self._chat_buckets[chat_id] = bucket
+            if len(self._chat_buckets) > CHAT_BUCKETS_SIZE:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def _call(self, callback, args, kwargs, endpoint, data, lane):
+        chat_id = data.get("chat_id")
+        chat_bucket = None
+        if chat_id is not None and endpoint.startswith(CHAT_LIMITED_PREFIXES):
+            chat_bucket = self._chat_bucket(chat_id)
+        fail_fast = chat_bucket is not None and lane == LANE_INTERACTIVE
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            if fail_fast:
+                paused = chat_bucket.paused_for()
+                if paused:
+                    raise RetryAfter(math.ceil(paused))
+                chat_bucket.charge()
+            elif chat_bucket is not None:
+                await chat_bucket.acquire(lane)
+            await self.bucket.acquire(lane)
+            BOT_API_QUEUE_WAIT.observe(time.monotonic() - started, LANE_NAMES[lane])
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                (self.bucket if chat_bucket is None else chat_bucket).pause(
+                    retry_after_seconds(e) + random.uniform(0, RETRY_AFTER_JITTER)
+                )
+                if fail_fast or attempt == self.max_retries:
+                    raise
+                logger.warning(f"{endpoint} hit flood control, pausing for {e.retry_after}s.")
+                BOT_API_RETRIES.inc(endpoint, "retry_after")
+            except NetworkError as e:
+                if (
+                    isinstance(e, BadRequest)
+                    or attempt == self.max_retries
+                    or (isinstance(e, TimedOut) and endpoint.startswith(NON_IDEMPOTENT_PREFIXES))
+                ):
+                    raise
+                BOT_API_RETRIES.inc(endpoint, "network")
+                await asyncio.sleep(random.uniform(0, RETRY_BASE_DELAY * 2 ** attempt))
+
+    def _forget(self, key, future):
+        self._in_flight.pop(key, None)
+        # Mark the error as seen even if every caller was cancelled meanwhile
+        if not future.cancelled():
+            future.exception()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        lane = LANE_INTERACTIVE if rate_limit_args is None else rate_limit_args
+        if endpoint not in COALESCED_METHODS:
+            return await self._call(callback, args, kwargs, endpoint, data, lane)
+
+        key = (endpoint, json.dumps(data, sort_keys=True, default=str))
+        future = self._in_flight.get(key)
+        if future is not None:
+            BOT_API_COALESCED.inc(endpoint)
+        else:
+            future = asyncio.ensure_future(self._call(callback, args, kwargs, endpoint, data, lane))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda done: self._forget(key, done))
+        # Shielded so a cancelled caller does not cancel the request for the others
+        return await asyncio.shield(future)
+
+
+api_rate_limiter = ApiRateLimiter()
+
+
+# Bot method and arguments that re-send the content of a message
+def broadcast_payload(message):
+    if message.sticker:
+        return "send_sticker", {"sticker": message.sticker.file_id}
+    if message.photo:
+        return "send_photo", {"photo": message.photo[-1].file_id}
+    if message.video:
+        return "send_video", {"video": message.video.file_id}
+    if message.document:
+        return "send_document", {"document": message.document.file_id}
+    if message.text:
+        return "send_message", {"text": message.text}
+    return None
+
+
+# Sends broadcasts concurrently under Telegram's rate limits
+class BroadcastEngine:
+    """Delivers a broadcast through a bounded pool of workers.
+
+    Sends use the background lane of the API rate limiter, which spaces
+    them out and retries flood-control responses. Each
+    recipient's outcome is committed to the broadcast_recipients table as
+    soon as it is known, so a broadcast job resumed after a restart only
+    reaches the recipients that were not reached yet.
+    """
+
+    def __init__(self, db_path, workers=BROADCAST_WORKERS):
+        self.db_path = db_path
+        self.workers = workers
+        self._db = None
+        self._bot = None
+
+    # Progress tables, opened on first use
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = self._open()
+        return self._db
+
+    def _open(self):
+        db = open_db(self.db_path)
+        with db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS broadcasts ("
+                "id INTEGER PRIMARY KEY, method TEXT NOT NULL, payload TEXT NOT NULL, "
+                "report_chat_id INTEGER, status TEXT NOT NULL, created_ts REAL NOT NULL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS broadcast_recipients ("
+                "broadcast_id INTEGER NOT NULL, chat_id INTEGER NOT NULL, status TEXT NOT NULL, "
+                "PRIMARY KEY (broadcast_id, chat_id))"
+            )
+        return db
+
+    def start(self, bot):
+        self._bot = bot
+
+    # Record a new broadcast; returns its id. Progress is reported by the job running it
+    def create(self, method, payload, recipients):
+        with self.db:
+            cursor = self.db.execute(
+                "INSERT INTO broadcasts (method, payload, status, created_ts) VALUES (?, ?, 'running', ?)",
+                (method, json.dumps(payload), time.time()),
+            )
+            self.db.executemany(
+                "INSERT INTO broadcast_recipients (broadcast_id, chat_id, status) VALUES (?, ?, 'pending')",
+                [(cursor.lastrowid, chat_id) for chat_id in recipients],
+            )
+        return cursor.lastrowid
 
-    # Set the timer for the group
-    group_settings[chat_id] = {"delete_timer": timer_minutes * 60, "auto_delete": True}
-    save_data()
+    # (id, report_chat_id) of every broadcast not finished yet
+    def unfinished(self):
+        return self.db.execute("SELECT id, report_chat_id FROM broadcasts WHERE status = 'running' ORDER BY id").fetchall()
 
-    await update.message.reply_text(f"Auto-delete timer set to {timer_minutes} minutes for this group.")
+    # Final status ("done", "failed" or "cancelled"), set by the job that ran the broadcast
+    def finish(self, broadcast_id, status):
+        with self.db:
+            self.db.execute("UPDATE broadcasts SET status = ? WHERE id = ?", (status, broadcast_id))
 
-# Handle auto-delete logic
-async def handle_auto_delete(update, delete_timer):
-    print(f"Delete timer set to: {delete_timer} seconds")  # Debugging line
-    await asyncio.sleep(delete_timer)
-    await update.message.delete()
+    def _counts(self, broadcast_id):
+        rows = self.db.execute(
+            "SELECT status, COUNT(*) FROM broadcast_recipients WHERE broadcast_id = ? GROUP BY status",
+            (broadcast_id,),
+        )
+        return dict(rows.fetchall())
+
+    def _record(self, broadcast_id, chat_id, status):
+        with self.db:
+            self.db.execute(
+                "UPDATE broadcast_recipients SET status = ? WHERE broadcast_id = ? AND chat_id = ?",
+                (status, broadcast_id, chat_id),
+            )
+
+    async def _send(self, method, payload, chat_id):
+        try:
+            await getattr(self._bot, method)(chat_id=chat_id, rate_limit_args=LANE_BACKGROUND, **payload)
+            return True
+        except Forbidden as e:
+            # Blocked by the user or removed from the group
+            registry.remove_chat(chat_id)
+            logger.info(f"Failed to send to {chat_id}: {e}")
+            return False
+        except Exception as e:
+            logger.info(f"Failed to send to {chat_id}: {e}")
+            return False
+
+    async def _worker(self, broadcast_id, method, payload, queue, recipient_done):
+        while not queue.empty():
+            chat_id = queue.get_nowait()
+            sent = await self._send(method, payload, chat_id)
+            BROADCAST_SENDS.inc("sent" if sent else "failed")
+            self._record(broadcast_id, chat_id, "sent" if sent else "failed")
+            await recipient_done()
+
+    # Deliver a broadcast to every recipient still pending; returns (sent, failed).
+    # `progress(done, total)` is awaited after every recipient
+    async def run(self, broadcast_id, progress=None):
+        method, payload = self.db.execute(
+            "SELECT method, payload FROM broadcasts WHERE id = ?", (broadcast_id,)
+        ).fetchone()
+        payload = json.loads(payload)
+        queue = asyncio.Queue()
+        for (chat_id,) in self.db.execute(
+            "SELECT chat_id FROM broadcast_recipients WHERE broadcast_id = ? AND status = 'pending'", (broadcast_id,)
+        ).fetchall():
+            queue.put_nowait(chat_id)
+        total = sum(self._counts(broadcast_id).values())
+        done = total - queue.qsize()
+
+        async def recipient_done():
+            nonlocal done
+            done += 1
+            if progress:
+                await progress(done, total)
 
+        try:
+            await asyncio.gather(*(
+                self._worker(broadcast_id, method, payload, queue, recipient_done) for _ in range(self.workers)
+            ))
+        except Exception as e:
+            logger.error(f"Broadcast {broadcast_id} failed: {e}")
+            raise
+
+        counts = self._counts(broadcast_id)
+        return counts.get("sent", 0), counts.get("failed", 0)
+
+
+broadcast_engine = BroadcastEngine(JOURNAL_DB_FILE)
 
 CMD_ON = 'on'
 CMD_OFF = 'off'
 async def toggle_auto_delete(update, context):
-    chat_id = str(update.message.chat.id)
+    user_id = update.message.from_user.id
+    chat_id = update.message.chat.id
+
+    # Check if the user is an admin or owner
+    if not await is_admin_or_owner(user_id, chat_id, context.bot):
+        await update.message.reply_text("Only group admins or the owner can change the auto-delete setting.")
+        return
 
-    group_config = group_settings.get(
+    group_config = state.group_settings.get(
         chat_id,
         {"delete_timer": DEFAULT_AUTO_DELETE_TIME, "auto_delete": True}
     )
@@ -127,65 +1719,99 @@ async def toggle_auto_delete(update, context):
         option = context.args[0].lower()
 
         if option == CMD_ON:
-            group_config["auto_delete"] = True
+            auto_delete = True
         elif option == CMD_OFF:
-            group_config["auto_delete"] = False
+            auto_delete = False
         else:
             await update.message.reply_text("Usage: /autodlt <on|off>")
             return
 
-        group_settings[chat_id] = group_config
-        save_data()
-        auto_delete_status = "enabled" if group_config["auto_delete"] else "disabled"
-        await update.message.reply_text(f"Auto-delete is now {auto_delete_status} for this group.")
+        state.update_group_settings(chat_id, **{**group_config, "auto_delete": auto_delete})
+        auto_delete_status = "enabled" if auto_delete else "disabled"
+        reply = f"Auto-delete is now {auto_delete_status} for this group."
+        if not auto_delete:
+            cancelled = deletion_scheduler.drop_chat(chat_id)
+            if cancelled:
+                reply += f" {cancelled} pending deletion(s) cancelled."
+        await update.message.reply_text(reply)
     else:
         await update.message.reply_text("Usage: /autodlt <on|off>")
 
 
-def load_auth_data():
-    """Loads JSON data from a file, returns an empty dictionary if the file doesn't exist or an error occurs."""
-    try:
-        if not os.path.exists('data.json'):
-            print("Data file does not exist. Initializing with empty data.")
-            return {}
-        with open('data.json', 'r') as file:
-            data = json.load(file)
-            print("Data loaded successfully:", data)
-            return data
-    except json.JSONDecodeError as e:
-        print(f"Error decoding JSON file: {e}. Returning empty data.")
-        return {}
-    except Exception as e:
-        print(f"Unexpected error loading JSON file: {e}")
-        return {}
+# Per-chat administrator ids with TTL and LRU eviction
+class AdminCache:
+    """Caches each chat's administrator ids as a set.
 
-def save_auth_data(updated_data):
-    """Merges updated data with existing data and saves to a file."""
-    try:
-        existing_data = load_auth_data()  # Load existing data
-        merged_data = {**existing_data, **updated_data}  # Merge existing and updated data
+    Concurrent lookups for a chat that is not cached share one
+    get_chat_administrators request. Entries expire after `ttl` seconds and
+    are dropped early when a ChatMemberUpdated shows an admin change.
+    """
 
-        with open('data.json', 'w') as file:
-            json.dump(merged_data, file, indent=4)  # Save the merged JSON data
-        print("Data saved successfully. Current data:", merged_data)
-    except Exception as e:
-        print(f"Error saving JSON file: {e}")
-def merge_dicts(d1, d2):
-    """Recursively merges two dictionaries."""
-    for k, v in d2.items():
-        if isinstance(v, dict) and k in d1 and isinstance(d1[k], dict):
-            d1[k] = merge_dicts(d1[k], v)
+    def __init__(self, ttl=ADMIN_CACHE_TTL, max_size=ADMIN_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._in_flight = {}
+
+    async def _fetch(self, chat_id, bot):
+        try:
+            chat_admins = await bot.get_chat_administrators(chat_id)
+            admin_ids = frozenset(admin.user.id for admin in chat_admins)
+            self._entries[chat_id] = (time.monotonic() + self.ttl, admin_ids)
+            self._entries.move_to_end(chat_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            return admin_ids
+        finally:
+            del self._in_flight[chat_id]
+
+    async def get(self, chat_id, bot):
+        entry = self._entries.get(chat_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(chat_id)
+            ADMIN_LOOKUPS.inc("hit")
+            return entry[1]
+        if chat_id in self._in_flight:
+            ADMIN_LOOKUPS.inc("coalesced")
         else:
-            d1[k] = v
-    return d1
+            ADMIN_LOOKUPS.inc("miss")
+            self._in_flight[chat_id] = asyncio.ensure_future(self._fetch(chat_id, bot))
+        return await asyncio.shield(self._in_flight[chat_id])
+
+    def invalidate(self, chat_id):
+        self._entries.pop(chat_id, None)
+
+
+admin_cache = AdminCache()
 
 async def is_admin_or_owner(user_id, chat_id, bot):
     if user_id == int(OWNER_ID):
+        ADMIN_LOOKUPS.inc("owner")
         return True
-    chat_admins = await bot.get_chat_administrators(chat_id)
-    return any(admin.user.id == user_id for admin in chat_admins)
+    return user_id in await admin_cache.get(chat_id, bot)
+
+# Drop cached admins when someone is promoted or demoted
+async def track_admin_changes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    change = update.chat_member
+    admin_statuses = (ChatMember.ADMINISTRATOR, ChatMember.OWNER)
+    was_admin = change.old_chat_member.status in admin_statuses
+    is_admin = change.new_chat_member.status in admin_statuses
+    if was_admin != is_admin:
+        admin_cache.invalidate(change.chat.id)
+
+# Track chats adding, removing or blocking the bot
+async def track_bot_membership(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    change = update.my_chat_member
+    if change.new_chat_member.status in (ChatMember.LEFT, ChatMember.BANNED):
+        registry.remove_chat(change.chat.id)
+        admin_cache.invalidate(change.chat.id)
+        deletion_scheduler.drop_chat(change.chat.id)
+        message_log.forget(change.chat.id)
+    else:
+        registry.see_chat(change.chat)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    registry.see_chat(update.message.chat)
     try:
         chat_type = update.message.chat.type
 
@@ -238,14 +1864,9 @@ async def authorize_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Invalid user ID. Please provide a valid numeric user ID.")
             return
 
-    # Load authentication data
-    auth_data = load_auth_data() or {'global_authorized_users': [], 'group_authorized_users': {}}
-
     if user_id == int(OWNER_ID):
         # Owner is authorizing; add to global only
-        if new_user_id not in auth_data['global_authorized_users']:
-            auth_data['global_authorized_users'].append(new_user_id)
-            save_auth_data(auth_data)
+        if state.authorize(new_user_id):
             await update.message.reply_text(f"User {new_user_id} has been authorized by owner.")
         else:
             await update.message.reply_text(f"User {new_user_id} is already globally authorized.")
@@ -256,14 +1877,7 @@ async def authorize_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # Handle group authorization for non-owner
-        group_authorized_users = auth_data['group_authorized_users']
-        if str(chat_id) not in group_authorized_users:
-            group_authorized_users[str(chat_id)] = []
-        if new_user_id not in group_authorized_users[str(chat_id)]:
-            group_authorized_users[str(chat_id)].append(new_user_id)
-            auth_data['group_authorized_users'] = group_authorized_users
-            save_auth_data(auth_data)
-
+        if state.authorize(new_user_id, chat_id):
             await update.message.reply_text(f"User {new_user_id} has been authorized in this group.")
         else:
             await update.message.reply_text(f"User {new_user_id} is already authorized in this group.")
@@ -272,12 +1886,8 @@ async def unauthorize_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     chat_id = update.message.chat.id
 
-    # Load authorization data
-    auth_data = load_auth_data() or {'global_authorized_users': [], 'group_authorized_users': {}}
-    group_admins = auth_data['group_authorized_users'].get(str(chat_id), [])
-
     # Check if the user is the bot owner or a group admin
-    if user_id != int(OWNER_ID) and user_id not in group_admins:
+    if user_id != int(OWNER_ID) and user_id not in state.group_authorized_users.get(chat_id, set()):
         await update.message.reply_text("Only the owner or group admins can unauthorize users.")
         return
 
@@ -297,59 +1907,372 @@ async def unauthorize_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if user_id == int(OWNER_ID):
         # Remove from global authorized list
-        if target_user_id in auth_data['global_authorized_users']:
-            auth_data['global_authorized_users'].remove(target_user_id)
+        if state.unauthorize(target_user_id):
             await update.message.reply_text(f"User {target_user_id} has been unauthorized by Owner.")
         else:
             await update.message.reply_text(f"User {target_user_id} was not authorized by Owner.")
 
     # Remove from group authorized list
-    if target_user_id in group_admins:
-        group_admins.remove(target_user_id)
+    if state.unauthorize(target_user_id, chat_id):
         await update.message.reply_text(f"User {target_user_id} has been unauthorized from group.")
 
-    # Save the updated authorization data
-    save_auth_data(auth_data)
 
+# Cached titles and liveness of the groups the bot was added to
+class GroupScanner:
+    """Validates stored groups with bounded parallel get_chat calls.
+
+    Results, including failures, are cached for CHAT_INFO_TTL seconds, so
+    /listgroup only contacts Telegram for groups whose entry went stale.
+    Groups that answer Forbidden or "chat not found" are pruned from the
+    stored group set.
+    """
+
+    def __init__(self, concurrency=CHAT_SCAN_CONCURRENCY, ttl=CHAT_INFO_TTL):
+        self.concurrency = concurrency
+        self.ttl = ttl
+        self._info = {}  # chat_id -> (checked_at, title or None)
+
+    def _is_fresh(self, chat_id):
+        entry = self._info.get(chat_id)
+        return entry is not None and time.monotonic() - entry[0] < self.ttl
+
+    async def _check(self, bot, chat_id, semaphore):
+        async with semaphore:
+            try:
+                chat = await bot.get_chat(chat_id, rate_limit_args=LANE_BACKGROUND)
+                title = chat.title
+            except Forbidden:
+                title = None
+                registry.remove_group(chat_id)
+            except BadRequest as e:
+                title = None
+                if "chat not found" in str(e).lower():
+                    registry.remove_group(chat_id)
+            except Exception as e:
+                title = None
+                logger.info(f"Could not fetch group {chat_id}: {e}")
+        self._info[chat_id] = (time.monotonic(), title)
+
+    # Refresh every stale group; returns {chat_id: title} of the valid ones.
+    # `progress(done, total)` is awaited after every group checked
+    async def scan(self, bot, force=False, progress=None):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        stale = [chat_id for chat_id in state.group_ids if force or not self._is_fresh(chat_id)]
+        done = 0
+
+        async def check(chat_id):
+            nonlocal done
+            await self._check(bot, chat_id, semaphore)
+            done += 1
+            if progress:
+                await progress(done, len(stale))
+
+        await asyncio.gather(*(check(chat_id) for chat_id in stale))
+        return {
+            chat_id: self._info[chat_id][1]
+            for chat_id in state.group_ids
+            if chat_id in self._info and self._info[chat_id][1]
+        }
+
+    # Keep the cache warm so /listgroup can answer without waiting on Telegram
+    async def refresh_loop(self, bot, interval=CHAT_REFRESH_INTERVAL):
+        while True:
+            try:
+                await self.scan(bot, force=True)
+            except Exception as e:
+                logger.error(f"Group refresh failed: {e}")
+            await asyncio.sleep(interval)
+
+
+group_scanner = GroupScanner()
+
+
+# A queued or running background job, as seen by the code doing its work
+class Job:
+    def __init__(self, runner, job_id, kind, params, chat_id, message_id, done=0, total=None):
+        self.runner = runner
+        self.id = job_id
+        self.kind = kind
+        self.params = params
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.done = done
+        self.total = total
+        self._reported_at = 0.0
+
+    @property
+    def bot(self):
+        return self.runner.bot
+
+    def describe(self, status, result=None):
+        text = f"Job {self.id} ({self.kind}) {status}"
+        if self.total:
+            text += f": {self.done}/{self.total} ({self.done * 100 // self.total}%)"
+        return f"{text}\n{result}" if result else text
+
+    # Record progress; the status message is edited at most every JOB_PROGRESS_INTERVAL seconds
+    async def progress(self, done, total):
+        self.done, self.total = done, total
+        now = time.monotonic()
+        if now - self._reported_at < JOB_PROGRESS_INTERVAL:
+            return
+        self._reported_at = now
+        self.runner.save_progress(self)
+        # /cancel may have come through another shard
+        if self.runner.status(self.id) == "cancelled":
+            self.runner.cancel(self.id)
+            return
+        await self.report("running")
 
-# Example save_auth_data and load_auth_data functions
-def save_auth_data(data):
-    with open('auth_data.json', 'w') as f:
-        json.dump(data, f)
+    async def report(self, status, result=None):
+        if self.message_id is None:
+            return
+        try:
+            await self.bot.edit_message_text(
+                chat_id=self.chat_id,
+                message_id=self.message_id,
+                text=self.describe(status, result),
+                rate_limit_args=LANE_BACKGROUND,
+            )
+        except Exception as e:
+            logger.info(f"Could not update the status message of job {self.id}: {e}")
+
+
+# Persistent queue of owner bulk operations
+class JobRunner:
+    """Runs /broadcast and /listgroup as background jobs.
+
+    Every job is a row in the jobs table of the journal database, and its
+    progress is shown by editing one status message in the chat that
+    started it. At most `concurrency` jobs run at once; the others wait as
+    queued. Jobs a restart left queued or running are resumed. /cancel
+    marks a job cancelled in the table and stops its task; a job running in
+    another shard notices at its next progress report.
+    """
+
+    def __init__(self, db_path, concurrency=JOB_CONCURRENCY):
+        self.db_path = db_path
+        self.bot = None
+        self._db = None
+        self._slots = asyncio.Semaphore(concurrency)
+        self._tasks = {}  # job id -> task, for jobs started by this process
+
+    # Jobs table, opened on first use
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = open_db(self.db_path)
+            with self._db:
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS jobs ("
+                    "id INTEGER PRIMARY KEY, kind TEXT NOT NULL, params TEXT NOT NULL, status TEXT NOT NULL, "
+                    "chat_id INTEGER NOT NULL, message_id INTEGER, done INTEGER NOT NULL DEFAULT 0, total INTEGER, "
+                    "result TEXT, created_ts REAL NOT NULL, finished_ts REAL)"
+                )
+        return self._db
+
+    def start(self, bot):
+        self.bot = bot
+
+    def _create(self, kind, params, chat_id):
+        with self.db:
+            cursor = self.db.execute(
+                "INSERT INTO jobs (kind, params, status, chat_id, created_ts) VALUES (?, ?, 'queued', ?, ?)",
+                (kind, json.dumps(params), chat_id, time.time()),
+            )
+        return Job(self, cursor.lastrowid, kind, params, chat_id, None)
+
+    def _set_message(self, job, message_id):
+        job.message_id = message_id
+        with self.db:
+            self.db.execute("UPDATE jobs SET message_id = ? WHERE id = ?", (message_id, job.id))
+
+    # Queue a job and post its status message in reply to `message`; returns the job id
+    async def submit(self, kind, params, message):
+        job = self._create(kind, params, message.chat.id)
+        status_message = await message.reply_text(job.describe("queued"))
+        self._set_message(job, status_message.message_id)
+        self._spawn(job)
+        return job.id
+
+    # Queue a job for work started outside the runner, posting its status message in `chat_id`
+    async def adopt(self, kind, params, chat_id):
+        job = self._create(kind, params, chat_id)
+        try:
+            status_message = await self.bot.send_message(chat_id=chat_id, text=job.describe("queued"))
+            self._set_message(job, status_message.message_id)
+        except Exception as e:
+            logger.info(f"Could not post the status message of job {job.id}: {e}")
+        self._spawn(job)
+        return job.id
+
+    # Parameters of every job of a kind, finished or not
+    def params(self, kind):
+        return [json.loads(params) for (params,) in self.db.execute("SELECT params FROM jobs WHERE kind = ?", (kind,))]
+
+    # Restart jobs interrupted by the last shutdown
+    def resume(self):
+        rows = self.db.execute(
+            "SELECT id, kind, params, chat_id, message_id, done, total FROM jobs "
+            "WHERE status IN ('queued', 'running') ORDER BY id"
+        ).fetchall()
+        for job_id, kind, params, chat_id, message_id, done, total in rows:
+            if job_id in self._tasks:
+                continue
+            logger.info(f"Resuming interrupted job {job_id} ({kind}).")
+            self._spawn(Job(self, job_id, kind, json.loads(params), chat_id, message_id, done, total))
+
+    def _spawn(self, job):
+        task = asyncio.create_task(self._run(job))
+        self._tasks[job.id] = task
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+        task.add_done_callback(lambda _: self._tasks.pop(job.id, None))
+
+    def status(self, job_id):
+        row = self.db.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row and row[0]
+
+    def save_progress(self, job):
+        with self.db:
+            self.db.execute("UPDATE jobs SET done = ?, total = ? WHERE id = ?", (job.done, job.total, job.id))
+
+    def _finish(self, job, status, result):
+        with self.db:
+            self.db.execute(
+                "UPDATE jobs SET status = ?, done = ?, total = ?, result = ?, finished_ts = ? WHERE id = ?",
+                (status, job.done, job.total, result, time.time(), job.id),
+            )
+        JOBS_FINISHED.inc(job.kind, status)
+        finisher = JOB_FINISHERS.get(job.kind)
+        if finisher:
+            finisher(job, status)
 
-def load_auth_data():
-    try:
-        with open('auth_data.json', 'r') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return None
+    async def _run(self, job):
+        try:
+            async with self._slots:
+                # Cancelled while queued, e.g. through another shard
+                if self.status(job.id) == "cancelled":
+                    await self._cancelled(job)
+                    return
+                with self.db:
+                    self.db.execute("UPDATE jobs SET status = 'running' WHERE id = ?", (job.id,))
+                await job.report("running")
+                result = await JOB_KINDS[job.kind](job)
+        except asyncio.CancelledError:
+            # Also raised while waiting for a slot
+            if self.status(job.id) != "cancelled":
+                raise  # Shutting down; the job resumes on the next start
+            await self._cancelled(job)
+            return
+        except Exception as e:
+            logger.error(f"Job {job.id} ({job.kind}) failed: {e}")
+            self._finish(job, "failed", str(e))
+            await job.report("failed", f"An error occurred: {e}")
+            return
+        self._finish(job, "done", result)
+        await job.report("done", result)
+
+    async def _cancelled(self, job):
+        self._finish(job, "cancelled", None)
+        await job.report("cancelled")
+
+    # Returns False if there is no such job or it already finished
+    def cancel(self, job_id):
+        with self.db:
+            cursor = self.db.execute(
+                "UPDATE jobs SET status = 'cancelled' WHERE id = ? AND status IN ('queued', 'running')", (job_id,)
+            )
+        task = self._tasks.get(job_id)
+        if task:
+            task.cancel()
+        return cursor.rowcount > 0
 
+    def recent(self, limit=JOBS_LISTED):
+        return self.db.execute(
+            "SELECT id, kind, status, done, total, created_ts FROM jobs ORDER BY id DESC LIMIT ?", (limit,)
+        ).fetchall()
+
+
+job_runner = JobRunner(JOURNAL_DB_FILE)
+
+async def run_broadcast_job(job):
+    sent, failed = await broadcast_engine.run(job.params["broadcast_id"], job.progress)
+    return f"✅ Successfully sent to: {sent}\n❌ Failed to send to: {failed}"
+
+def finish_broadcast_job(job, status):
+    broadcast_engine.finish(job.params["broadcast_id"], status)
+
+# Broadcasts left running by a version that ran them without jobs resume as jobs
+async def adopt_broadcasts():
+    owned = {params["broadcast_id"] for params in job_runner.params("broadcast")}
+    for broadcast_id, report_chat_id in broadcast_engine.unfinished():
+        if broadcast_id not in owned:
+            logger.info(f"Resuming interrupted broadcast {broadcast_id} as a job.")
+            await job_runner.adopt("broadcast", {"broadcast_id": broadcast_id}, report_chat_id or int(OWNER_ID))
+
+async def run_listgroup_job(job):
+    # Count the group only if its title is not None or empty
+    valid_groups = list((await group_scanner.scan(job.bot, progress=job.progress)).values())
+
+    if valid_groups:
+        group_names = "\n".join(valid_groups)
+        await job.bot.send_message(
+            chat_id=job.chat_id,
+            text=f"The bot is added to the following valid groups:\n{group_names}\n\nTotal number of valid groups: {len(valid_groups)}",
+        )
+    else:
+        await job.bot.send_message(chat_id=job.chat_id, text="The bot is not added to any valid groups.")
+    return f"{len(valid_groups)} valid groups."
+
+# Coroutine doing the work of each job kind; returns the summary shown in the status message
+JOB_KINDS = {
+    "broadcast": run_broadcast_job,
+    "listgroup": run_listgroup_job,
+}
+
+# Called with the final status ("done", "failed" or "cancelled") of jobs that keep state of their own
+JOB_FINISHERS = {
+    "broadcast": finish_broadcast_job,
+}
 
 async def list_groups(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.from_user.id != int(OWNER_ID):
         await update.message.reply_text("Only the bot owner can use this command.")
         return
 
-    valid_groups = []
+    await job_runner.submit("listgroup", {}, update.message)
 
-    # Loop through all group IDs
-    for group_id in group_ids:
-        try:
-            # Try to get the group chat information
-            chat = await context.bot.get_chat(group_id)
+async def list_jobs(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id != int(OWNER_ID):
+        await update.message.reply_text("Only the bot owner can use this command.")
+        return
 
-            # Count the group only if its title is not None or empty
-            if chat.title:
-                valid_groups.append(chat.title)
-        except Exception as e:
-            # Skip any group where fetching details failed (no valid group)
-            continue
+    jobs = job_runner.recent()
+    if not jobs:
+        await update.message.reply_text("No jobs yet.")
+        return
+    lines = []
+    for job_id, kind, status, done, total, created_ts in jobs:
+        started = time.strftime("%Y-%m-%d %H:%M", time.localtime(created_ts))
+        progress = f" {done}/{total}" if total else ""
+        lines.append(f"#{job_id} {kind}: {status}{progress} (queued {started})")
+    await update.message.reply_text("Recent jobs:\n" + "\n".join(lines))
+
+async def cancel_job(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id != int(OWNER_ID):
+        await update.message.reply_text("Only the bot owner can use this command.")
+        return
 
-    if valid_groups:
-        group_names = "\n".join(valid_groups)
-        await update.message.reply_text(f"The bot is added to the following valid groups:\n{group_names}\n\nTotal number of valid groups: {len(valid_groups)}")
+    if len(context.args) != 1 or not context.args[0].isdigit():
+        await update.message.reply_text("Usage: /cancel <job_id>")
+        return
+
+    job_id = int(context.args[0])
+    if job_runner.cancel(job_id):
+        await update.message.reply_text(f"Job {job_id} cancelled.")
     else:
-        await update.message.reply_text("The bot is not added to any valid groups.")
+        await update.message.reply_text(f"Job {job_id} is not queued or running.")
 
 
 
@@ -358,7 +2281,7 @@ async def count_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Only the bot owner can use this command.")
         return
 
-    total_users = len(started_users)
+    total_users = len(state.started_users)
     await update.message.reply_text(f"Total number of users who started the bot: {total_users}")
 
 
@@ -371,180 +2294,394 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Please reply to a message to broadcast it.")
         return
 
-    recipients = list(started_users | group_ids)
-    success_count = 0
-    failure_count = 0
+    # Check the type of the message to be broadcasted
+    payload = broadcast_payload(update.message.reply_to_message)
+    if payload is None:
+        await update.message.reply_text("Unsupported media type for broadcasting.")
+        return
 
-    try:
-        # Check the type of the message to be broadcasted
-        if update.message.reply_to_message.sticker:
-            media = update.message.reply_to_message.sticker.file_id
-            for recipient in recipients:
-                try:
-                    await context.bot.send_sticker(chat_id=recipient, sticker=media)
-                    success_count += 1
-                except Exception as e:
-                    print(f"Failed to send to {recipient}: {e}")
-                    failure_count += 1
-        elif update.message.reply_to_message.photo:
-            media = update.message.reply_to_message.photo[-1].file_id
-            for recipient in recipients:
-                try:
-                    await context.bot.send_photo(chat_id=recipient, photo=media)
-                    success_count += 1
-                except Exception as e:
-                    print(f"Failed to send to {recipient}: {e}")
-                    failure_count += 1
-        elif update.message.reply_to_message.video:
-            media = update.message.reply_to_message.video.file_id
-            for recipient in recipients:
-                try:
-                    await context.bot.send_video(chat_id=recipient, video=media)
-                    success_count += 1
-                except Exception as e:
-                    print(f"Failed to send to {recipient}: {e}")
-                    failure_count += 1
-        elif update.message.reply_to_message.document:
-            media = update.message.reply_to_message.document.file_id
-            for recipient in recipients:
-                try:
-                    await context.bot.send_document(chat_id=recipient, document=media)
-                    success_count += 1
-                except Exception as e:
-                    print(f"Failed to send to {recipient}: {e}")
-                    failure_count += 1
-        elif update.message.reply_to_message.text:
-            media = update.message.reply_to_message.text
-            for recipient in recipients:
-                try:
-                    await context.bot.send_message(chat_id=recipient, text=media)
-                    success_count += 1
-                except Exception as e:
-                    print(f"Failed to send to {recipient}: {e}")
-                    failure_count += 1
-        else:
-            await update.message.reply_text("Unsupported media type for broadcasting.")
+    # The job's status message shows progress and the summary once every recipient is done
+    method, kwargs = payload
+    recipients = state.started_users | state.group_ids
+    broadcast_id = broadcast_engine.create(method, kwargs, recipients)
+    await job_runner.submit("broadcast", {"broadcast_id": broadcast_id}, update.message)
+
+# Announcements of deleted edits, collapsed per user and chat
+class EditAnnouncer:
+    """Announces a user's first deleted edit at once, then sums the rest.
+
+    Further edits by the same user in the same chat within `window`
+    seconds only bump a counter, and a single "edited N more messages"
+    follow-up goes out when the window closes, so a mass edit costs two
+    messages instead of one per edit.
+    """
+
+    def __init__(self, window=EDIT_ANNOUNCE_WINDOW):
+        self.window = window
+        self._open = {}  # (chat_id, user_id) -> edits since the first announcement
+
+    def __len__(self):
+        return len(self._open)
+
+    def add(self, bot, chat_id, user):
+        key = (chat_id, user.id)
+        if key in self._open:
+            self._open[key] += 1
             return
+        self._open[key] = 0
+        task = asyncio.create_task(self._announce(bot, key, user.mention_html()))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
 
-        # Send broadcast completion summary
-        await update.message.reply_text(
-            f"Broadcast completed.\n\n"
-            f"✅ Successfully sent to: {success_count}\n"
-            f"❌ Failed to send to: {failure_count}"
-        )
+    async def _announce(self, bot, key, mention):
+        chat_id = key[0]
+        try:
+            await self._send(bot, chat_id, f" 𝘙𝘰𝘴𝘦𝘴 𝘢𝘳𝘦 𝘳𝘦𝘥, 𝘷𝘪𝘰𝘭𝘦𝘵𝘴 𝘢𝘳𝘦 𝘣𝘭𝘶𝘦, {mention} 𝘦𝘥𝘪𝘵𝘦𝘥 𝘢 𝘮𝘦𝘴𝘴𝘢𝘨𝘦, 𝘯𝘰𝘸 𝘪𝘵'𝘴 𝘨𝘰𝘯𝘦 𝘛𝘰𝘰!😮‍💨")
+            await asyncio.sleep(self.window)
+        finally:
+            more = self._open.pop(key)
+        if more:
+            await self._send(bot, chat_id, f"{mention} edited {more} more message(s), they're gone too! 😮‍💨")
+
+    async def _send(self, bot, chat_id, text):
+        try:
+            await bot.send_message(chat_id=chat_id, text=text, parse_mode="HTML", rate_limit_args=LANE_BACKGROUND)
+        except Exception as e:
+            logger.info(f"Failed to announce an edit in {chat_id}: {e}")
 
-    except Exception as e:
-        await update.message.reply_text(f"An error occurred during broadcast: {e}")
 
-async def handle_edited_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.edited_message.from_user
-    chat_id = update.edited_message.chat.id
-    user_id = user.id
+edit_announcer = EditAnnouncer()
 
-    # Load authentication data
-    auth_data = load_auth_data() or {'global_authorized_users': [], 'group_authorized_users': {}}
+async def handle_edited_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.edited_message
+    user = message.from_user
+    chat_id = message.chat.id
 
-    # Check if the user is globally authorized
-    if user_id in auth_data['global_authorized_users']:
+    # Skip anonymous admins and globally or group authorized users
+    if user is None or state.is_exempt(user.id, chat_id):
         return
 
-    # Check if the user is authorized in the specific group
-    if str(chat_id) in auth_data['group_authorized_users'] and user_id in auth_data['group_authorized_users'][str(chat_id)]:
+    edit_policy = state.policy(chat_id).edit_policy
+    EDITED_MESSAGES.inc(edit_policy)
+    if edit_policy == "off":
         return
+    deletion_scheduler.schedule(chat_id, message.message_id, 0)
+    if edit_policy == "delete":
+        edit_announcer.add(context.bot, chat_id, user)
+
+# Message pipeline stages, cheapest first; each one can end processing early
+
+# Content types the policy engine tells apart, checked in this order (animations also carry a document)
+MEDIA_TYPES = ("animation", "photo", "video", "video_note", "voice", "audio", "document", "sticker")
+CONTENT_TYPES = ("text", "service") + MEDIA_TYPES
+LINK_ENTITY_TYPES = ("url", "text_link")
+
+# Stage 1: classify the message as "service", "text" or one of MEDIA_TYPES
+def classify_message(message):
+    if message.new_chat_members or message.left_chat_member or message.pinned_message:
+        return "service"
+    for kind in MEDIA_TYPES:
+        if getattr(message, kind):
+            return kind
+    return "text"
+
+def has_link(message):
+    entities = message.entities or message.caption_entities
+    return any(entity.type in LINK_ENTITY_TYPES for entity in entities)
+
+# The file object of a media message; the largest size for photos
+def media_file(message, kind):
+    return message.photo[-1] if kind == "photo" else getattr(message, kind)
+
+# A group's deletion settings compiled into a lookup table
+class GroupPolicy:
+    """Decides how long a message may stay in a group.
+
+    `ttls` maps every content type that gets deleted to its delay in
+    seconds; types missing from it are kept. It is built once from the
+    group's settings (delete_timer, text_auto_delete, per-type type_timers
+    overrides), so deciding a message is a dict lookup plus whichever
+    exemptions the group turned on.
+    """
+
+    __slots__ = (
+        "ttls", "exempt_channel_forwards", "exempt_links", "small_file_limit", "edit_policy",
+        "flood_limit", "flood_window", "flood_mute",
+    )
 
-    try:
-        username = user.mention_html()
-        announcement = f" 𝘙𝘰𝘴𝘦𝘴 𝘢𝘳𝘦 𝘳𝘦𝘥, 𝘷𝘪𝘰𝘭𝘦𝘵𝘴 𝘢𝘳𝘦 𝘣𝘭𝘶𝘦, {username} 𝘦𝘥𝘪𝘵𝘦𝘥 𝘢 𝘮𝘦𝘴𝘴𝘢𝘨𝘦, 𝘯𝘰𝘸 𝘪𝘵'𝘴 𝘨𝘰𝘯𝘦 𝘛𝘰𝘰!😮‍💨"
-
-        # Send announcement about the edited message
-        await context.bot.send_message(chat_id=chat_id, text=announcement, parse_mode="HTML")
-
-        # Delete the edited message
-        await update.edited_message.delete()
-    except Exception as e:
-        print(f"Failed to delete edited message: {e}")
+    def __init__(self, settings):
+        self.ttls = {}
+        self.edit_policy = settings.get("edit_policy", "delete")  # One of EDIT_POLICIES
+        self.flood_limit = settings.get("flood_limit", 0)  # Messages per flood_window; 0 disables the detector
+        self.flood_window = settings.get("flood_window", 10)  # seconds
+        self.flood_mute = settings.get("flood_mute", 0)  # seconds a flooding user is muted for; 0 only deletes
+        self.exempt_channel_forwards = settings.get("exempt_channel_forwards", False)
+        self.exempt_links = settings.get("exempt_links", False)
+        self.small_file_limit = settings.get("exempt_small_files", 0)  # bytes; smaller files are kept
+        if not settings.get("auto_delete", False):
+            return
+        delete_timer = settings.get("delete_timer", 10)  # Default to 10 seconds if no timer is set
+        for kind in MEDIA_TYPES:
+            self.ttls[kind] = delete_timer
+        # Service messages follow the text setting, as they always have
+        if settings.get("text_auto_delete", True):
+            self.ttls["text"] = self.ttls["service"] = delete_timer
+        for kind, ttl in settings.get("type_timers", {}).items():
+            if ttl is None:
+                self.ttls.pop(kind, None)
+            else:
+                self.ttls[kind] = ttl
+
+    # Stage 3: seconds until deletion, or None to keep the message
+    def delay(self, message, kind):
+        ttl = self.ttls.get(kind)
+        if ttl is None:
+            return None
+        if self.exempt_channel_forwards and message.forward_origin and message.forward_origin.type == "channel":
+            return None
+        if self.exempt_links and has_link(message):
+            return None
+        if self.small_file_limit and kind in MEDIA_TYPES:
+            size = media_file(message, kind).file_size
+            if size is not None and size < self.small_file_limit:
+                return None
+        return ttl
+
+
+# What happens to edited messages: deleted and announced, deleted quietly, or kept
+EDIT_POLICIES = {
+    "delete": "deleted and announced",
+    "silent": "deleted without an announcement",
+    "off": "kept",
+}
+
+# Policy of groups without any settings: keep everything but edits
+NO_POLICY = GroupPolicy({})
+
+# Sliding-window message counts per (chat, user)
+class FloodDetector:
+    """Counts each user's recent messages per chat.
+
+    A counter is a ring of BUCKETS sub-window counts plus their total, so
+    recording a message and reading the count over the last `window`
+    seconds are O(1) and every counter has the same small size. The window
+    slides one bucket (window / BUCKETS) at a time. Counters are kept in
+    least recently used order, capped at `max_counters`; counters idle for
+    a whole window hold nothing and are evicted as new messages arrive.
+    """
+
+    BUCKETS = 8
+
+    def __init__(self, max_counters=FLOOD_MAX_COUNTERS):
+        self.max_counters = max_counters
+        self._counters = OrderedDict()  # (chat_id, user_id) -> [ring, newest bucket number, total, bucket width]
+
+    def __len__(self):
+        return len(self._counters)
+
+    # Record a message; returns how many the user sent in the chat over the last `window` seconds
+    def hit(self, chat_id, user_id, window, now=None):
+        now = time.monotonic() if now is None else now
+        key = (chat_id, user_id)
+        width = window / self.BUCKETS
+        bucket = int(now / width)
+        counter = self._counters.get(key)
+        if counter is None or counter[3] != width or bucket - counter[1] >= self.BUCKETS:
+            counter = self._counters[key] = [[0] * self.BUCKETS, bucket, 0, width]
+        else:
+            ring = counter[0]
+            # Empty the buckets that slid out of the window since the last message
+            for number in range(counter[1] + 1, bucket + 1):
+                counter[2] -= ring[number % self.BUCKETS]
+                ring[number % self.BUCKETS] = 0
+            counter[1] = bucket
+        self._counters.move_to_end(key)
+        counter[0][bucket % self.BUCKETS] += 1
+        counter[2] += 1
+        self._evict(now)
+        return counter[2]
+
+    def _evict(self, now):
+        counters = self._counters
+        while counters:
+            key, counter = next(iter(counters.items()))
+            if len(counters) <= self.max_counters and int(now / counter[3]) - counter[1] < self.BUCKETS:
+                break
+            del counters[key]
+
+
+flood_detector = FloodDetector()
+metrics.callback("bot_flood_counters", "Per-user message counters held by the flood detector.", "gauge", lambda: len(flood_detector))
+
+
+# Recent messages of every group, for deleting a backlog after the fact
+class MessageLog:
+    """Remembers the last `capacity` messages of each group.
+
+    Every chat has its own file: a small header followed by fixed-size
+    (sender, message id, date, type) records used as a ring. The file is
+    memory-mapped, so recording a message is one struct.pack_into and the
+    log survives restarts without explicit writes. At most `max_open`
+    files stay mapped; the least recently used are unmapped first. Shards
+    handle disjoint chats, so no file is shared between processes.
+    """
+
+    HEADER = struct.Struct("<4sIQ")  # magic, capacity, messages recorded so far
+    RECORD = struct.Struct("<qiIB3x")  # sender id, message id, unix date, CONTENT_TYPES index
+    TYPE_OFFSET = 16  # Offset of the type byte within a record
+    MAGIC = b"MLG1"
+    PURGED = 255  # Type of records already handed out for deletion
+
+    def __init__(self, directory=MESSAGE_LOG_DIR, capacity=MESSAGE_LOG_SIZE, max_open=MESSAGE_LOG_OPEN_MAX):
+        self.directory = directory
+        self.capacity = capacity
+        self.max_open = max_open
+        self.size = self.HEADER.size + capacity * self.RECORD.size
+        self._maps = OrderedDict()  # chat_id -> mmap
+
+    def _path(self, chat_id):
+        return os.path.join(self.directory, f"{chat_id}.ring")
+
+    # Mapped ring file of a chat; None if `create` is false and the chat has none
+    def _map(self, chat_id, create=True):
+        ring = self._maps.get(chat_id)
+        if ring is not None:
+            self._maps.move_to_end(chat_id)
+            return ring
+        path = self._path(chat_id)
+        if not create and not os.path.exists(path):
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != self.size:
+                # New file, or one written with another capacity: start empty
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self.size)
+            ring = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        if self.HEADER.unpack_from(ring, 0)[0] != self.MAGIC:
+            self.HEADER.pack_into(ring, 0, self.MAGIC, self.capacity, 0)
+        self._maps[chat_id] = ring
+        while len(self._maps) > self.max_open:
+            self._maps.popitem(last=False)[1].close()
+        return ring
+
+    def record(self, chat_id, message_id, sender_id, kind, date):
+        ring = self._map(chat_id)
+        recorded = self.HEADER.unpack_from(ring, 0)[2]
+        offset = self.HEADER.size + recorded % self.capacity * self.RECORD.size
+        self.RECORD.pack_into(ring, offset, sender_id, message_id, int(date), KIND_CODES[kind])
+        self.HEADER.pack_into(ring, 0, self.MAGIC, self.capacity, recorded + 1)
+
+    # Ids of logged messages sent since `since` (unix time) with a type in `kinds`, newest first.
+    # Records for which skip_sender(sender_id) is true are left alone; the rest are never returned again
+    def take(self, chat_id, since, kinds, skip_sender):
+        ring = self._map(chat_id, create=False)
+        if ring is None:
+            return []
+        codes = {KIND_CODES[kind] for kind in kinds}
+        recorded = self.HEADER.unpack_from(ring, 0)[2]
+        message_ids = []
+        for n in range(recorded - 1, max(recorded - self.capacity, 0) - 1, -1):
+            offset = self.HEADER.size + n % self.capacity * self.RECORD.size
+            sender_id, message_id, date, code = self.RECORD.unpack_from(ring, offset)
+            if date < since:
+                break
+            if code in codes and not skip_sender(sender_id):
+                message_ids.append(message_id)
+                ring[offset + self.TYPE_OFFSET] = self.PURGED
+        return message_ids
+
+    # The bot left the chat: its message ids are of no further use
+    def forget(self, chat_id):
+        ring = self._maps.pop(chat_id, None)
+        if ring is not None:
+            ring.close()
+        try:
+            os.remove(self._path(chat_id))
+        except FileNotFoundError:
+            pass
 
+    def close(self):
+        while self._maps:
+            self._maps.popitem()[1].close()
 
-import json
-import asyncio
-import json
-import asyncio
-from telegram import Update
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
 
-# Function to load the auth data from the JSON file
-def load_auth_data():
-    try:
-        with open('data.json', 'r') as file:
-            return json.load(file)  # Load the JSON data
-    except Exception as e:
-        print(f"Error loading JSON file: {e}")
-        return {}
+KIND_CODES = {kind: code for code, kind in enumerate(CONTENT_TYPES)}
+message_log = MessageLog()
 
-# Function to save auth data to JSON file (if you want to dynamically update the file)
-def save_auth_data(data):
+# Mute a user who flooded a chat; runs as a task so the chat's other updates are not held up
+async def restrict_flooder(bot, chat_id, user_id, seconds):
     try:
-        with open('data.json', 'w') as file:
-            json.dump(data, file, indent=4)  # Save the JSON data
-    except Exception as e:
-        print(f"Error saving JSON file: {e}")
-# Function to handle message deletion
-async def delete_message(context, chat_id, message_id, delete_timer):
-    try:
-        await asyncio.sleep(delete_timer)  # Wait before deleting
-        await context.bot.delete_message(chat_id=chat_id, message_id=message_id)  # Attempt to delete the message
-
+        await bot.restrict_chat_member(
+            chat_id=chat_id,
+            user_id=user_id,
+            permissions=ChatPermissions.no_permissions(),
+            until_date=int(time.time() + seconds),
+            rate_limit_args=LANE_DELETION,
+        )
+        FLOOD_RESTRICTIONS.inc("muted")
+        logger.info(f"Muted {user_id} in {chat_id} for {seconds} s after a message flood.")
     except Exception as e:
-        print(f"")
+        FLOOD_RESTRICTIONS.inc("failed")
+        logger.info(f"Failed to mute {user_id} in {chat_id}: {e}")
 
 # Function to handle new messages
 async def handle_new_message(update, context):
-    try:
-        # Check if update.message exists and is valid
-        if update.message is None:
-            print("Error: No message found in the update.")
-            return  # Exit early if there's no message
-
-        # Reload auth data dynamically every time a message is handled
-        auth_data = load_auth_data()
-
-        # Ensure chat and message are available
-        chat_id = update.message.chat.id if update.message.chat else None
-        message_id = update.message.message_id if update.message.message_id else None
-        user_id = update.message.from_user.id if update.message.from_user else None
-
-        # If any necessary attribute is missing, log and return
-        if not chat_id or not message_id or not user_id:
-            print("Error: Missing chat, message, or user data.")
-            return
+    message = update.message
+    MESSAGES_SEEN.inc(message.chat.id)
+    registry.see_chat(message.chat)
+    if message.migrate_to_chat_id:
+        # The group was upgraded to a supergroup with a new id
+        registry.remove_group(message.chat.id)
+        registry.add_group(message.migrate_to_chat_id)
+    if message.from_user is None:
+        return
+    chat_id = message.chat.id
+    user_id = message.from_user.id
 
-        # Fetch the group configuration for the chat
-        group_config = auth_data.get('group_settings', {}).get(str(chat_id), {})
+    kind = classify_message(message)
+    if chat_id < 0:
+        message_log.record(chat_id, message.message_id, user_id, kind, message.date.timestamp())
 
-        # Check if the user is globally authorized
-        if user_id in auth_data["global_authorized_users"]:
-            return
+    # Stage 2: skip globally or group authorized users
+    if state.is_exempt(user_id, chat_id):
+        return
 
-        # Check if the user is authorized in the specific group
-        elif str(chat_id) in auth_data["group_authorized_users"] and user_id in auth_data["group_authorized_users"].get(str(chat_id), []):
+    # Flagged media is removed on arrival; the Bloom filter answers the common case without I/O
+    if kind in MEDIA_TYPES and chat_id < 0:
+        if media_index.is_flagged(media_file(message, kind).file_unique_id, chat_id):
+            FLAGGED_MEDIA_DELETIONS.inc()
+            deletion_scheduler.schedule(chat_id, message.message_id, 0)
+            return
+        if kind == "photo" and photo_hasher:
+            photo_hasher.check(context.bot, message)
+
+    policy = state.policy(chat_id)
+
+    # Messages beyond the group's flood limit are removed at once instead of waiting for their timer
+    if policy.flood_limit and chat_id < 0:
+        count = flood_detector.hit(chat_id, user_id, policy.flood_window)
+        if count > policy.flood_limit:
+            FLOOD_DELETIONS.inc()
+            deletion_scheduler.schedule(chat_id, message.message_id, 0)
+            if policy.flood_mute and count == policy.flood_limit + 1:
+                task = asyncio.create_task(restrict_flooder(context.bot, chat_id, user_id, policy.flood_mute))
+                background_tasks.add(task)
+                task.add_done_callback(background_tasks.discard)
             return
 
-        # If auto-delete is enabled for the group, proceed with deletion
-        if group_config.get("auto_delete", False):
-            # Check the message type and the text auto-delete setting
-            is_media_message = bool(update.message.photo or update.message.video or update.message.document or update.message.audio)
-            text_auto_delete = group_config.get("text_auto_delete", True)
+    delete_timer = policy.delay(message, kind)
+    if delete_timer is None:
+        return
 
-            # Determine if the message should be deleted based on its type
-            if text_auto_delete or is_media_message:
-                delete_timer = group_config.get("delete_timer", 10)  # Default to 10 seconds if no timer is set
-                asyncio.create_task(delete_message(context, chat_id, message_id, delete_timer))
+    # Stage 4: enqueue the deletion
+    deletion_scheduler.schedule(chat_id, message.message_id, delete_timer)
 
-    except Exception as e:
-        print(f"Error in handle_new_message: {e}")
 async def set_timer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message is None:
-        print("No message found in update")  # Debugging line
         return
 
     user_id = update.message.from_user.id
@@ -555,30 +2692,219 @@ async def set_timer(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Only group admins or the owner can change the delete timer.")
         return
 
+    # /settimer <type> <minutes|off|default> overrides the timer of one content type
+    if len(context.args) == 2:
+        await set_type_timer(update, chat_id, context.args[0].lower(), context.args[1].lower())
+        return
+
     # Ensure a proper argument is provided
     if len(context.args) != 1 or not context.args[0].isdigit():
-        await update.message.reply_text("Usage: /settimer <time_in_minutes>")
+        await update.message.reply_text(SETTIMER_USAGE)
         return
 
     # Get the timer value from the command argument and convert from minutes to seconds
     delete_time_minutes = int(context.args[0])
     delete_time_seconds = delete_time_minutes * 60  # Convert to seconds
 
-    # Load the current group settings
-    auth_data = load_auth_data()
-    group_settings = auth_data.get('group_settings', {})
+    # Update the delete timer for the group
+    state.update_group_settings(chat_id, delete_timer=delete_time_seconds)
 
-    if str(chat_id) not in group_settings:
-        group_settings[str(chat_id)] = {}
+    await update.message.reply_text(f"Delete timer has been set to {delete_time_minutes} minute(s) for this group.")
 
-    # Update the delete timer for the group
-    group_settings[str(chat_id)]['delete_timer'] = delete_time_seconds
+# Reply to a media message to flag it: the owner's flags apply everywhere, admins' in their group
+async def flag_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    chat_id = update.message.chat.id
+
+    if not await is_admin_or_owner(user_id, chat_id, context.bot):
+        await update.message.reply_text("Only group admins or the owner can flag media.")
+        return
 
-    # Save the updated settings
-    auth_data['group_settings'] = group_settings
-    save_auth_data(auth_data)
+    target = update.message.reply_to_message
+    kind = classify_message(target) if target else None
+    if kind not in MEDIA_TYPES:
+        await update.message.reply_text("Reply to a photo, video, document or sticker with /flag.")
+        return
 
-    await update.message.reply_text(f"Delete timer has been set to {delete_time_minutes} minute(s) for this group.")
+    scope = MediaIndex.GLOBAL_CHAT_ID if user_id == int(OWNER_ID) else chat_id
+    media_index.flag(media_file(target, kind).file_unique_id, scope, user_id)
+    if kind == "photo" and photo_hasher:
+        photo_hasher.remember(context.bot, target, scope)
+    deletion_scheduler.schedule(chat_id, target.message_id, 0)
+    where = "any group" if scope == MediaIndex.GLOBAL_CHAT_ID else "this group"
+    await update.message.reply_text(f"Media flagged. Copies posted in {where} will be deleted on arrival.")
+
+async def unflag_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    chat_id = update.message.chat.id
+
+    if not await is_admin_or_owner(user_id, chat_id, context.bot):
+        await update.message.reply_text("Only group admins or the owner can unflag media.")
+        return
+
+    target = update.message.reply_to_message
+    kind = classify_message(target) if target else None
+    if kind in MEDIA_TYPES:
+        file_unique_id = media_file(target, kind).file_unique_id
+    elif context.args:
+        file_unique_id = context.args[0]
+    else:
+        await update.message.reply_text("Usage: reply to the media with /unflag, or /unflag <file_unique_id>")
+        return
+
+    scope = MediaIndex.GLOBAL_CHAT_ID if user_id == int(OWNER_ID) else chat_id
+    if media_index.unflag(file_unique_id, scope):
+        await update.message.reply_text("Media unflagged.")
+    else:
+        await update.message.reply_text("That media is not flagged.")
+
+SETTIMER_USAGE = (
+    "Usage: /settimer <time_in_minutes>\n"
+    "or /settimer <type> <minutes|off|default>\n"
+    f"Types: media, {', '.join(CONTENT_TYPES)}"
+)
+
+# "media" covers every MEDIA_TYPES entry; "default" goes back to the group's delete timer
+async def set_type_timer(update: Update, chat_id, kind, value):
+    if (kind != "media" and kind not in CONTENT_TYPES) or not (value.isdigit() or value in ("off", "default")):
+        await update.message.reply_text(SETTIMER_USAGE)
+        return
+
+    type_timers = dict(state.get_group_settings(chat_id).get("type_timers", {}))
+    for content_type in MEDIA_TYPES if kind == "media" else (kind,):
+        if value == "default":
+            type_timers.pop(content_type, None)
+        else:
+            type_timers[content_type] = None if value == "off" else int(value) * 60
+    state.update_group_settings(chat_id, type_timers=type_timers)
+
+    if value == "default":
+        await update.message.reply_text(f"{kind.capitalize()} messages now use the group's delete timer.")
+    elif value == "off":
+        await update.message.reply_text(f"{kind.capitalize()} messages will no longer be deleted in this group.")
+    else:
+        await update.message.reply_text(f"{kind.capitalize()} messages will be deleted after {value} minute(s) in this group.")
+
+# Keep channel forwards, messages with links or small files out of auto-delete
+async def set_exemption(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    chat_id = update.message.chat.id
+
+    if not await is_admin_or_owner(user_id, chat_id, context.bot):
+        await update.message.reply_text("Only group admins or the owner can change exemptions.")
+        return
+
+    usage = "Usage: /exempt <forwards|links> <on|off> or /exempt smallfiles <size_in_kb|off>"
+    if len(context.args) != 2:
+        await update.message.reply_text(usage)
+        return
+
+    name, value = context.args[0].lower(), context.args[1].lower()
+    if name in ("forwards", "links") and value in ("on", "off"):
+        setting, label = {
+            "forwards": ("exempt_channel_forwards", "Forwards from channels"),
+            "links": ("exempt_links", "Messages with links"),
+        }[name]
+        state.update_group_settings(chat_id, **{setting: value == "on"})
+        status = "kept" if value == "on" else "auto-deleted like other messages"
+        await update.message.reply_text(f"{label} are now {status} in this group.")
+    elif name == "smallfiles" and (value.isdigit() or value == "off"):
+        limit = 0 if value == "off" else int(value) * 1024
+        state.update_group_settings(chat_id, exempt_small_files=limit)
+        if limit:
+            await update.message.reply_text(f"Files smaller than {value} KB are now kept in this group.")
+        else:
+            await update.message.reply_text("Small files are now auto-deleted like other messages in this group.")
+    else:
+        await update.message.reply_text(usage)
+
+async def set_flood_limit(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    chat_id = update.message.chat.id
+
+    if not await is_admin_or_owner(user_id, chat_id, context.bot):
+        await update.message.reply_text("Only group admins or the owner can change the flood limit.")
+        return
+
+    args = [arg.lower() for arg in context.args]
+    if args == ["off"]:
+        state.update_group_settings(chat_id, flood_limit=0)
+        await update.message.reply_text("Flood detection is now off in this group.")
+        return
+    valid = len(args) in (2, 3) and all(arg.isdigit() for arg in args)
+    if not valid or int(args[0]) == 0 or int(args[1]) == 0:
+        await update.message.reply_text(
+            "Usage: /flood <messages> <seconds> [mute_minutes] or /flood off\n"
+            "Messages beyond the limit are deleted at once; with mute_minutes the sender is also muted."
+        )
+        return
+
+    limit, window = int(args[0]), int(args[1])
+    mute = int(args[2]) * 60 if len(args) == 3 else 0
+    state.update_group_settings(chat_id, flood_limit=limit, flood_window=window, flood_mute=mute)
+    reply = f"Messages beyond {limit} per user in {window} seconds are now deleted at once"
+    if mute:
+        reply += f", and the sender is muted for {mute // 60} minute(s)"
+    await update.message.reply_text(reply + ".")
+
+# Delete the logged messages of the given types sent in the last `minutes`; returns how many
+def purge_backlog(chat_id, minutes, kinds):
+    since = time.time() - min(minutes * 60, BOT_DELETE_MAX_AGE)
+    message_ids = message_log.take(chat_id, since, kinds, lambda sender_id: state.is_exempt(sender_id, chat_id))
+    # The scheduler sends them as bulk deleteMessages calls
+    for message_id in message_ids:
+        deletion_scheduler.schedule(chat_id, message_id, 0)
+    return len(message_ids)
+
+async def purge_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    chat_id = update.message.chat.id
+
+    if not await is_admin_or_owner(user_id, chat_id, context.bot):
+        await update.message.reply_text("Only group admins or the owner can purge messages.")
+        return
+
+    if len(context.args) != 1 or not context.args[0].isdigit() or int(context.args[0]) == 0:
+        await update.message.reply_text("Usage: /purge <minutes>\nDeletes messages sent in the last <minutes> minutes.")
+        return
+
+    count = purge_backlog(chat_id, int(context.args[0]), CONTENT_TYPES)
+    await update.message.reply_text(f"Deleting {count} message(s) from the last {context.args[0]} minute(s).")
+
+async def purge_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    chat_id = update.message.chat.id
+
+    if not await is_admin_or_owner(user_id, chat_id, context.bot):
+        await update.message.reply_text("Only group admins or the owner can purge messages.")
+        return
+
+    if len(context.args) > 1 or (context.args and not context.args[0].isdigit()):
+        await update.message.reply_text(
+            "Usage: /purgemedia [minutes]\nDeletes media sent in the last [minutes] minutes, "
+            "or all media the bot still remembers."
+        )
+        return
+
+    minutes = int(context.args[0]) if context.args else BOT_DELETE_MAX_AGE // 60
+    count = purge_backlog(chat_id, minutes, MEDIA_TYPES)
+    await update.message.reply_text(f"Deleting {count} media message(s).")
+
+async def set_edit_policy(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.id
+    chat_id = update.message.chat.id
+
+    if not await is_admin_or_owner(user_id, chat_id, context.bot):
+        await update.message.reply_text("Only group admins or the owner can change the edit policy.")
+        return
+
+    if len(context.args) != 1 or context.args[0].lower() not in EDIT_POLICIES:
+        await update.message.reply_text(f"Usage: /editpolicy <{'|'.join(EDIT_POLICIES)}>")
+        return
+
+    edit_policy = context.args[0].lower()
+    state.update_group_settings(chat_id, edit_policy=edit_policy)
+    await update.message.reply_text(f"Edited messages are now {EDIT_POLICIES[edit_policy]} in this group.")
 
 
 
@@ -589,13 +2915,14 @@ async def new_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if chat.type in ['group', 'supergroup']:
         for member in new_members:
             if member.id == context.bot.id:
+                registry.add_group(chat.id)
                 try:
                     await context.bot.send_message(
                         chat_id=chat.id,
                         text="Hey! Thanks for adding me to your group. Click - /start to enable my functions 🙃"
                     )
                 except Forbidden:
-                    print(f"Cannot send message to chat {chat.id}. The bot might have been removed or lacks permissions.")
+                    logger.warning(f"Cannot send message to chat {chat.id}. The bot might have been removed or lacks permissions.")
                 break  # No need to check other members once the bot is found
 
 async def toggle_text_auto_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -615,67 +2942,19 @@ async def toggle_text_auto_delete(update: Update, context: ContextTypes.DEFAULT_
     # Update the text auto-delete setting for the group
     text_auto_delete = context.args[0].lower() == "on"
 
-    # Load the authentication data from the JSON file
-    auth_data = load_auth_data()
-    group_settings = auth_data.get('group_settings', {})
-
-    # Ensure the group settings exist for this chat
-    if str(chat_id) not in group_settings:
-        group_settings[str(chat_id)] = {}
-
-    # Set the default value to False (off) if it's not already set
-    current_setting = group_settings[str(chat_id)].get('text_auto_delete', False)  # Default is False (off)
-
-    # Update the text auto-delete setting based on the command
-    group_settings[str(chat_id)]['text_auto_delete'] = text_auto_delete
-
-    # Save the updated data without resetting other settings
-    auth_data['group_settings'] = group_settings
-    save_auth_data(auth_data)
+    # Save the setting without resetting other settings
+    state.update_group_settings(chat_id, text_auto_delete=text_auto_delete)
 
     status = "enabled" if text_auto_delete else "disabled"
     await update.message.reply_text(f"Text auto-delete has been {status} for this group.")
-async def show_group_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.message.from_user.id
-    chat_id = update.message.chat.id
-
-    # Load data from the JSON file
-    data = load_data()  # Assuming load_data loads the settings from 'data.json'
-    group_settings = data.get("group_settings", {})
-
-    # Ensure the group settings exist for the current chat
-    if str(chat_id) in group_settings:
-        settings = group_settings[str(chat_id)]
-        delete_timer_seconds = settings.get('delete_timer', DEFAULT_AUTO_DELETE_TIME)
-        delete_timer_minutes = delete_timer_seconds / 60  # Convert back to minutes for display
-
-        await update.message.reply_text(
-            f"Group Settings:\nDelete timer: {delete_timer_minutes} minute(s)\nAuto-delete: {'enabled' if settings.get('auto_delete', True) else 'disabled'}"
-        )
-    else:
-        await update.message.reply_text("No settings found for this group.")
-
-
-from telegram import Update, ChatMember
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
-
-# Helper function to load settings from data.json
-import json
-
-def load_data():
-    with open("data.json", "r") as f:
-        return json.load(f)
 
 async def show_group_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat.id
-    auth_data = load_auth_data()
-    group_settings = auth_data.get('group_settings', {})
-
-    if str(chat_id) not in group_settings:
+    if chat_id not in state.group_settings:
         await update.message.reply_text("No settings found for this group.")
         return
 
-    group_setting = group_settings[str(chat_id)]
+    group_setting = state.group_settings[chat_id]
 
     # Get the delete time and auto delete settings
     delete_time = group_setting.get('delete_timer', 'Not set')
@@ -687,17 +2966,471 @@ async def show_group_settings(update: Update, context: ContextTypes.DEFAULT_TYPE
     # Format the status as "on" or "off"
     text_auto_delete_status = "enabled" if text_auto_delete else "disabled"
 
+    type_timers = ", ".join(
+        f"{kind} {'off' if ttl is None else f'{ttl // 60} min'}"
+        for kind, ttl in group_setting.get("type_timers", {}).items()
+    )
+    flood_limit = "off"
+    if group_setting.get("flood_limit"):
+        flood_limit = f"{group_setting['flood_limit']} messages per {group_setting.get('flood_window', 10)} s"
+        if group_setting.get("flood_mute"):
+            flood_limit += f", mute {group_setting['flood_mute'] // 60} min"
+    exemptions = []
+    if group_setting.get("exempt_channel_forwards"):
+        exemptions.append("channel forwards")
+    if group_setting.get("exempt_links"):
+        exemptions.append("links")
+    if group_setting.get("exempt_small_files"):
+        exemptions.append(f"files under {group_setting['exempt_small_files'] // 1024} KB")
+
     # Prepare the message
     settings_message = (
         f"Group Settings:\n"
         f"Delete time: {delete_time} min\n"
         f"Auto delete: {'on' if auto_delete else 'off'}\n"
-        f"Text auto delete: {text_auto_delete_status}"
+        f"Text auto delete: {text_auto_delete_status}\n"
+        f"Type timers: {type_timers or 'none'}\n"
+        f"Exempt: {', '.join(exemptions) or 'none'}\n"
+        f"Flood limit: {flood_limit}\n"
+        f"Edited messages: {EDIT_POLICIES[group_setting.get('edit_policy', 'delete')]}"
     )
     await update.message.reply_text(settings_message)
 
-def main():
-    application = ApplicationBuilder().token("7738387262:AAFlJILd8J2BupXtBGBhSOYpKr3Uf5diP-s").build()
+# Concurrent update processing that keeps each chat's updates in order
+class UpdateQueue(asyncio.Queue):
+    """Application update queue that bounds the updates in flight.
+
+    The Application takes every update off its queue as soon as it arrives
+    and starts a task for it, so a bounded queue alone never fills up. It
+    calls task_done() only once the update has been handled, so this queue
+    counts from put() to task_done() instead: put() waits while `limit`
+    updates are queued or being handled, which holds up getUpdates polling,
+    webhook responses and shard feeds until handlers catch up.
+    """
+
+    def __init__(self, limit=MAX_PENDING_UPDATES):
+        super().__init__()
+        self.limit = limit
+        self.in_flight = 0
+        self._room = asyncio.Event()
+
+    def put_nowait(self, item):
+        super().put_nowait(item)
+        self.in_flight += 1
+
+    async def put(self, item):
+        while self.in_flight >= self.limit:
+            self._room.clear()
+            await self._room.wait()
+        self.put_nowait(item)
+
+    def task_done(self):
+        super().task_done()
+        self.in_flight -= 1
+        self._room.set()
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Shards updates by chat id onto `workers` FIFO queues.
+
+    Each queue is drained by one worker, so updates from different chats are
+    handled concurrently while updates from the same chat (e.g. a message and
+    its later edit) are always processed one after another in arrival order.
+    """
+
+    def __init__(self, workers=UPDATE_WORKERS, max_pending=MAX_PENDING_UPDATES):
+        super().__init__(max_concurrent_updates=max_pending)
+        self.workers = workers
+        self._queues = []
+        self._tasks = []
+
+    async def initialize(self):
+        self._queues = [asyncio.Queue() for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+
+    async def shutdown(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self, queue):
+        while True:
+            coroutine, future = await queue.get()
+            started = time.perf_counter()
+            try:
+                await coroutine
+                if not future.done():
+                    future.set_result(None)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                UPDATE_LATENCY.observe(time.perf_counter() - started)
+                queue.task_done()
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        key = chat.id if chat else getattr(update, "update_id", 0)
+        future = asyncio.get_running_loop().create_future()
+        self._queues[key % self.workers].put_nowait((coroutine, future))
+        await future
+
+
+# Minimal asyncio HTTP/1.1 server for the webhook listener
+class HttpServer:
+    """Serves `handler(method, path, headers, body) -> (status, content_type, body)`.
+
+    The optional `check(method, path, headers)` sees each request before its
+    body is read and may answer it by returning a response instead of None.
+    Bodies over `max_body` bytes are refused with 413. Either way the body is
+    left unread and the connection is closed.
+
+    Headers and body each have HTTP_READ_TIMEOUT seconds to arrive (408),
+    and headers are capped at HTTP_MAX_HEADERS lines and
+    HTTP_MAX_HEADER_BYTES bytes (431), so a client that has not been checked
+    yet cannot hold a connection open or grow the headers without bound.
+    Idle keep-alive connections are closed after HTTP_READ_TIMEOUT too.
+
+    stop() closes the listening socket first and then waits up to
+    SHUTDOWN_DRAIN_TIMEOUT seconds for requests already being handled.
+    """
+
+    def __init__(self, handler, host, port, check=None, max_body=WEBHOOK_MAX_BODY):
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.check = check
+        self.max_body = max_body
+        self._server = None
+        self._in_flight = set()
+        self._writers = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle_connection, self.host, self.port, limit=HTTP_MAX_HEADER_BYTES
+        )
+        logger.info(f"Listening on http://{self.host}:{self.port}")
+
+    async def stop(self):
+        self._server.close()
+        if self._in_flight:
+            await asyncio.wait(self._in_flight, timeout=SHUTDOWN_DRAIN_TIMEOUT)
+        # Idle keep-alive connections would otherwise hold wait_closed() open
+        for writer in list(self._writers):
+            writer.close()
+        await self._server.wait_closed()
+
+    async def _handle_connection(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), HTTP_READ_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break  # Idle keep-alive connection
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                try:
+                    headers = await asyncio.wait_for(self._read_headers(reader), HTTP_READ_TIMEOUT)
+                except asyncio.TimeoutError:
+                    await self._respond(writer, (408, "text/plain", b"Request Timeout"), closing=True)
+                    break
+                if headers is None:
+                    await self._respond(writer, (431, "text/plain", b"Request Header Fields Too Large"), closing=True)
+                    break
+                length = int(headers.get("content-length", 0))
+                response = self.check(method, path, headers) if self.check else None
+                if response is None and not 0 <= length <= self.max_body:
+                    response = 413, "text/plain", b"Payload Too Large"
+                if response is not None:
+                    await self._respond(writer, response, closing=True)
+                    break
+                try:
+                    body = await asyncio.wait_for(reader.readexactly(length), HTTP_READ_TIMEOUT)
+                except asyncio.TimeoutError:
+                    await self._respond(writer, (408, "text/plain", b"Request Timeout"), closing=True)
+                    break
+
+                task = asyncio.ensure_future(self.handler(method, path, headers, body))
+                self._in_flight.add(task)
+                try:
+                    response = await task
+                finally:
+                    self._in_flight.discard(task)
+
+                closing = not self._server.is_serving() or headers.get("connection", "").lower() == "close"
+                await self._respond(writer, response, closing)
+                if closing:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    # Header lines up to the blank line that ends them; None if they go over the caps
+    @staticmethod
+    async def _read_headers(reader):
+        headers = {}
+        size = 0
+        for _ in range(HTTP_MAX_HEADERS + 1):
+            try:
+                line = await reader.readline()
+            except ValueError:  # A single line over the stream limit
+                return None
+            if line in (b"\r\n", b"\n", b""):
+                return headers
+            size += len(line)
+            if size > HTTP_MAX_HEADER_BYTES:
+                return None
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        return None
+
+    @staticmethod
+    async def _respond(writer, response, closing):
+        status, content_type, payload = response
+        writer.write(
+            f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+            f"Content-Type: {content_type}\r\nContent-Length: {len(payload)}\r\n"
+            f"Connection: {'close' if closing else 'keep-alive'}\r\n\r\n".encode("latin-1")
+            + payload
+        )
+        await writer.drain()
+
+
+# Refuses webhook requests that are not from Telegram before their body is read
+def webhook_check(secret):
+    expected = secret.encode()
+
+    def check(method, path, headers):
+        if method != "POST" or path != WEBHOOK_PATH:
+            return 404, "text/plain", b"Not Found"
+        if not hmac.compare_digest(headers.get("x-telegram-bot-api-secret-token", "").encode("latin-1"), expected):
+            return 403, "text/plain", b"Forbidden"
+        return None
+    return check
+
+# Feeds updates posted by Telegram into the application's update queue
+def webhook_handler(application):
+    async def handle(method, path, headers, body):
+        try:
+            data = json.loads(body)
+            if not isinstance(data, dict):
+                raise ValueError("update is not a JSON object")
+            update = Update.de_json(data, application.bot)
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            logger.warning(f"Rejected malformed webhook update: {e}")
+            return 400, "text/plain", b"Bad Request"
+        await application.update_queue.put(update)
+        return 200, "text/plain", b"OK"
+    return handle
+
+# Run the application behind the local webhook listener until SIGINT/SIGTERM
+async def run_webhook(application: Application):
+    if not WEBHOOK_URL:
+        raise SystemExit("WEBHOOK_URL must be set to the bot's public base URL in webhook mode.")
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    # Without a secret anyone who can reach the listener could post updates
+    secret = WEBHOOK_SECRET
+    if not secret:
+        secret = secrets.token_urlsafe(32)
+        logger.info("WEBHOOK_SECRET is not set; using a secret generated for this run.")
+    await application.bot.set_webhook(
+        url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=secret,
+        allowed_updates=Update.ALL_TYPES,
+    )
+    server = HttpServer(
+        webhook_handler(application), WEBHOOK_LISTEN, WEBHOOK_PORT, check=webhook_check(secret)
+    )
+    await server.start()
+    await application.start()
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    await stop_event.wait()
+
+    # Stop accepting updates, finish the requests in flight, then let the
+    # application process everything already queued before shutting down
+    await server.stop()
+    await application.stop()
+    if application.post_stop:
+        await application.post_stop(application)
+    await application.shutdown()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+# Counts and times every Bot API call made through the wrapped request
+class InstrumentedRequest(BaseRequest):
+    def __init__(self, inner):
+        self.inner = inner
+
+    @property
+    def read_timeout(self):
+        return self.inner.read_timeout
+
+    async def initialize(self):
+        await self.inner.initialize()
+
+    async def shutdown(self):
+        await self.inner.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await self.inner.do_request(
+                url, method, request_data, read_timeout, write_timeout, connect_timeout, pool_timeout
+            )
+        finally:
+            BOT_API_CALLS.inc(api_method)
+            BOT_API_LATENCY.observe(time.perf_counter() - started, api_method)
+        if code == 429:
+            BOT_API_RATE_LIMITED.inc(api_method)
+        return code, payload
+
+
+async def metrics_handler(method, path, headers, body):
+    if method == "GET" and path == "/metrics":
+        return 200, "text/plain; version=0.0.4", metrics.render().encode()
+    return 404, "text/plain", b"Not Found"
+
+# Owner-only summary of the metrics
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id != int(OWNER_ID):
+        await update.message.reply_text("Only the bot owner can use this command.")
+        return
+
+    shard_note = ""
+    if shard_index is not None:
+        shard_note = f"\nShard {shard_index + 1} of {SHARDS} (counts cover this shard only)"
+    await update.message.reply_text(
+        f"Messages seen: {MESSAGES_SEEN.total()} in {len(MESSAGES_SEEN.values)} chats\n"
+        f"Deletions: {DELETIONS_SCHEDULED.total()} scheduled, {deletion_scheduler.messages_deleted} executed, "
+        f"{deletion_scheduler.messages_skipped} skipped, {len(deletion_scheduler)} pending\n"
+        f"Deletion calls: {deletion_scheduler.api_calls} ({deletion_scheduler.calls_saved} saved, "
+        f"{deletion_scheduler.failed_calls} failed)\n"
+        f"Bot API calls: {BOT_API_CALLS.total()} ({BOT_API_RATE_LIMITED.total()} rate limited, "
+        f"{BOT_API_RETRIES.total()} retried, {BOT_API_COALESCED.total()} coalesced)\n"
+        f"Broadcast sends: {BROADCAST_SENDS.values.get(('sent',), 0)} sent, "
+        f"{BROADCAST_SENDS.values.get(('failed',), 0)} failed\n"
+        f"Admin lookups: {ADMIN_LOOKUPS.values.get(('hit',), 0)} cached, "
+        f"{ADMIN_LOOKUPS.values.get(('miss',), 0)} fetched, {ADMIN_LOOKUPS.values.get(('coalesced',), 0)} coalesced\n"
+        f"Average update handling: {UPDATE_LATENCY.mean() * 1000:.2f} ms\n"
+        f"Storage writes: {STORAGE_WRITES.total()}{shard_note}"
+    )
+
+# Background tasks started with the application and cancelled on shutdown
+background_tasks = set()
+
+metrics_server = None
+
+# Each process serves its own metrics: the receiver on METRICS_PORT, shard i on METRICS_PORT + 1 + i
+async def start_metrics_server():
+    global metrics_server
+    if not METRICS_PORT:
+        return
+    port = METRICS_PORT if shard_index is None else METRICS_PORT + 1 + shard_index
+    try:
+        metrics_server = HttpServer(metrics_handler, METRICS_LISTEN, port)
+        await metrics_server.start()
+    except OSError as e:
+        metrics_server = None
+        logger.warning(f"Metrics endpoint disabled: {e}")
+
+def load_state():
+    with startup_timer.phase("state"):
+        state.load()
+
+# Only what handlers need is loaded before updates flow; everything else starts in deferred_startup
+async def post_init(application: Application):
+    startup_timer.checkpoint("initialize")
+    # State loads on a thread while the deletion journal and media index load here
+    state_loaded = asyncio.get_running_loop().run_in_executor(None, load_state)
+    if shard_index is None:
+        background_tasks.add(deletion_scheduler.start(application.bot))
+    else:
+        background_tasks.add(deletion_scheduler.start(application.bot, shard=(shard_index, SHARDS)))
+    startup_timer.checkpoint("deletion journal")
+    media_index.open()
+    startup_timer.checkpoint("media index")
+    await state_loaded
+    background_tasks.add(asyncio.create_task(state.watch()))
+    background_tasks.add(asyncio.create_task(state.writer.run()))
+    background_tasks.add(asyncio.create_task(media_index.watch()))
+    broadcast_engine.start(application.bot)
+    job_runner.start(application.bot)
+    background_tasks.add(asyncio.create_task(deferred_startup(application)))
+    logger.info(f"Startup: {startup_timer.report()}")
+
+# Subsystems nothing on the update path waits for
+async def deferred_startup(application: Application):
+    await start_metrics_server()
+    # Owner-wide work runs once, in the shard that handles the owner's private chat
+    if shard_index is None or shard_index == shard_of(int(OWNER_ID)):
+        job_runner.resume()
+        await adopt_broadcasts()
+        background_tasks.add(asyncio.create_task(group_scanner.refresh_loop(application.bot)))
+        background_tasks.add(asyncio.create_task(snapshot_loop()))
+
+async def post_shutdown(application: Application):
+    if metrics_server:
+        await metrics_server.stop()
+    if photo_hasher:
+        photo_hasher.shutdown()
+    message_log.close()
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+
+# Record raw updates as JSON lines for `benchmark.py load --replay`
+def update_recorder(path):
+    log_file = open(path, "a", buffering=1)
+    async def record_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        log_file.write(update.to_json() + "\n")
+    return record_update
+
+# Builder with the token, Bot API connection pool and rate limiter every application here shares
+def api_builder(request=None):
+    if request is None:
+        request = HTTPXRequest(
+            connection_pool_size=BOT_API_POOL_SIZE,
+            connect_timeout=BOT_API_CONNECT_TIMEOUT,
+            read_timeout=BOT_API_READ_TIMEOUT,
+            write_timeout=BOT_API_WRITE_TIMEOUT,
+            pool_timeout=BOT_API_POOL_TIMEOUT,
+        )
+    return (
+        ApplicationBuilder()
+        .token("7738387262:AAFlJILd8J2BupXtBGBhSOYpKr3Uf5diP-s")
+        .base_url(BOT_API_BASE_URL)
+        .request(InstrumentedRequest(request))
+        .rate_limiter(api_rate_limiter)
+        .update_queue(UpdateQueue())
+    )
+
+# Build the application with every handler registered; `request` replaces the HTTP client (e.g. in benchmarks)
+def build_application(request=None):
+    builder = (
+        api_builder(request)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(ChatOrderedUpdateProcessor())
+    )
+    application = builder.build()
+
+    if UPDATE_LOG_FILE:
+        application.add_handler(TypeHandler(Update, update_recorder(UPDATE_LOG_FILE)), group=-1)
 
     # Adding CommandHandlers
     application.add_handler(CommandHandler("start", start))
@@ -706,23 +3439,181 @@ def main():
     application.add_handler(CommandHandler("listgroup", list_groups))
     application.add_handler(CommandHandler("countuser", count_users))
     application.add_handler(CommandHandler("broadcast", broadcast))
+    application.add_handler(CommandHandler("jobs", list_jobs))
+    application.add_handler(CommandHandler("cancel", cancel_job))
     application.add_handler(CommandHandler("settimer", set_timer))
     application.add_handler(CommandHandler("autodlt", toggle_auto_delete))
     application.add_handler(CommandHandler("textautodlt", toggle_text_auto_delete))
+    application.add_handler(CommandHandler("exempt", set_exemption))
+    application.add_handler(CommandHandler("editpolicy", set_edit_policy))
+    application.add_handler(CommandHandler("flood", set_flood_limit))
+    application.add_handler(CommandHandler("purge", purge_messages))
+    application.add_handler(CommandHandler("purgemedia", purge_media))
+    application.add_handler(CommandHandler("flag", flag_media))
+    application.add_handler(CommandHandler("unflag", unflag_media))
+    application.add_handler(CommandHandler("stats", show_stats))
 
     # Add the /showsetting command handler
     showsetting_handler = CommandHandler("showsetting", show_group_settings)
     application.add_handler(showsetting_handler)
 
     # Add other handlers like new chat members, new messages, etc.
+    application.add_handler(ChatMemberHandler(track_admin_changes, ChatMemberHandler.CHAT_MEMBER))
+    application.add_handler(ChatMemberHandler(track_bot_membership, ChatMemberHandler.MY_CHAT_MEMBER))
     application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, new_chat_member))
-    application.add_handler(MessageHandler(filters.ALL & ~filters.UpdateType.EDITED_MESSAGE, handle_new_message))
     application.add_handler(MessageHandler(filters.UpdateType.EDITED_MESSAGE, handle_edited_message))
-    application.add_handler(MessageHandler(filters.ALL & ~filters.UpdateType.EDITED_MESSAGE, delete_message))
-    application.add_handler(MessageHandler(filters.ALL, handle_auto_delete))
+    # Single catch-all entry: every other message goes through the pipeline in handle_new_message
+    application.add_handler(MessageHandler(filters.UpdateType.MESSAGE, handle_new_message))
+    return application
+
+# Shard handled by this process; None outside supervisor mode
+shard_index = None
+
+# Worker process that handles a chat's updates in supervisor mode
+def shard_of(chat_id, shards=SHARDS):
+    return abs(chat_id) % shards
+
+
+# Update processor of the receiver: hands every update to its chat's shard instead of handling it
+class ShardRouter(BaseUpdateProcessor):
+    def __init__(self, supervisor):
+        super().__init__(max_concurrent_updates=MAX_PENDING_UPDATES)
+        self.supervisor = supervisor
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update, coroutine):
+        coroutine.close()
+        chat = update.effective_chat if isinstance(update, Update) else None
+        self.supervisor.route(chat.id if chat else update.update_id, update.to_json())
+
+
+class ShardSupervisor:
+    """Runs one worker process per shard and restarts workers that exit.
+
+    Each worker gets its updates as JSON over its own multiprocessing queue,
+    so a chat is always handled by the same process and in arrival order.
+    Workers share bot.db and journal.db: settings and authorizations written
+    by one shard reach the others through BotState.watch(), which is what
+    owner commands like /countuser, /listgroup and /broadcast read.
+    """
+
+    def __init__(self, shards=SHARDS):
+        self._context = multiprocessing.get_context("spawn")
+        self.queues = [self._context.Queue() for _ in range(shards)]
+        self.processes = [None] * shards
+        self._monitor = None
+
+    def _spawn(self, index):
+        process = self._context.Process(
+            target=run_shard_worker, args=(index, self.queues[index]), name=f"shard-{index}"
+        )
+        process.start()
+        self.processes[index] = process
+
+    def route(self, chat_id, payload):
+        index = shard_of(chat_id, len(self.queues))
+        self.queues[index].put(payload)
+        SHARD_UPDATES.inc(str(index))
+
+    async def monitor(self):
+        while True:
+            await asyncio.sleep(SHARD_CHECK_INTERVAL)
+            for index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    # A worker killed inside queue.get() leaves the queue's read lock held, so the
+                    # replacement gets a new queue; updates still waiting in the old one are lost
+                    logger.warning(f"Shard {index} exited with code {process.exitcode}, restarting it.")
+                    self.queues[index] = self._context.Queue()
+                    self._spawn(index)
+
+    def start(self):
+        for index in range(len(self.queues)):
+            self._spawn(index)
+        self._monitor = asyncio.create_task(self.monitor())
+
+    # Ask every worker to finish the updates it was sent, then wait for it to exit
+    async def stop(self):
+        if self._monitor:
+            self._monitor.cancel()
+            await asyncio.gather(self._monitor, return_exceptions=True)
+        for queue in self.queues:
+            queue.put(None)
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + SHUTDOWN_DRAIN_TIMEOUT
+        for index, process in enumerate(self.processes):
+            await loop.run_in_executor(None, process.join, max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"Shard {index} did not stop in time, terminating it.")
+                process.terminate()
+
+
+# Entry point of a worker process
+def run_shard_worker(index, queue):
+    global shard_index
+    shard_index = index
+    # Ctrl+C reaches the whole process group; workers stop when the supervisor tells them to
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve_shard(queue))
+
+async def serve_shard(queue):
+    application = build_application()
+    startup_timer.checkpoint("build")
+    # Telegram's global limit is shared by all shards
+    api_rate_limiter.bucket = TokenBucket(BOT_API_RATE / SHARDS)
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    logger.info(f"Shard {shard_index} of {SHARDS} started.")
+
+    loop = asyncio.get_running_loop()
+    while True:
+        payload = await loop.run_in_executor(None, queue.get)
+        if payload is None:
+            break
+        await application.update_queue.put(Update.de_json(json.loads(payload), application.bot))
+
+    await application.stop()
+    await application.shutdown()
+    await application.post_shutdown(application)
+
+# Application that only receives updates (polling or webhook) and routes them to the shards
+def build_receiver(supervisor):
+    async def receiver_post_init(application: Application):
+        startup_timer.checkpoint("initialize")
+        supervisor.start()
+        startup_timer.checkpoint("shards")
+        await start_metrics_server()
+        logger.info(f"Startup: {startup_timer.report()}")
+
+    async def receiver_post_shutdown(application: Application):
+        if metrics_server:
+            await metrics_server.stop()
+        await supervisor.stop()
+
+    return (
+        api_builder()
+        .post_init(receiver_post_init)
+        .post_shutdown(receiver_post_shutdown)
+        .concurrent_updates(ShardRouter(supervisor))
+        .build()
+    )
+
+startup_timer.checkpoint("import")
+
+def main():
+    application = build_receiver(ShardSupervisor()) if SHARDS else build_application()
+    startup_timer.checkpoint("build")
 
     # Start the bot
-    application.run_polling()
+    if RUN_MODE == "webhook":
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
     main()
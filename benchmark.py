@@ -0,0 +1,332 @@
+"""Offline benchmarks for the message hot path.
+
+    python benchmark.py micro --updates 20000 --groups 100
+    python benchmark.py load --updates 50000 --groups 100 --auth-users 20
+    python benchmark.py load --replay updates.jsonl
+    python benchmark.py idset --ids 1000000
+
+`micro` times Application.process_update for plain text messages, one at a
+time. `load` pushes a synthetic (or recorded) stream of text, photo, video,
+document and edited messages through the running Application, including the
+concurrent update processor and the deletion scheduler. It reports
+throughput, handler and end-to-end latency percentiles, peak task count,
+pending deletions, RSS and the Bot API calls made. `idset` compares the
+memory, lookup, union and serialization cost of IdSet with a plain set.
+
+Record real traffic for --replay by starting the bot with
+UPDATE_LOG_FILE=updates.jsonl.
+
+The bot is imported inside a scratch directory with a fresh database, so the
+real bot.db and data.json are never touched. Every Bot API call is answered
+in-process by fake_bot_api.FakeBotAPI, so no network access is needed.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from array import array
+
+from telegram import Update
+from telegram.ext import TypeHandler
+from telegram.request import BaseRequest
+
+from fake_bot_api import FakeBotAPI
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+CONTENT_TYPES = ("text", "photo", "video", "document")
+
+
+# Answers Bot API requests in-process instead of over HTTP
+class OfflineRequest(BaseRequest):
+    def __init__(self):
+        self.api = FakeBotAPI()
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        params = request_data.parameters if request_data else {}
+        result = await self.api.call(url.rsplit("/", 1)[-1], params)
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+# Import the bot from a scratch directory so its database lives there
+def import_bot():
+    os.chdir(tempfile.mkdtemp(prefix="bot-benchmark-"))
+    sys.path.insert(0, REPO_DIR)
+    import Copyrightsaver_bot
+    return Copyrightsaver_bot
+
+
+def message_update(update_id, chat_id, user_id, content="text", edited=False):
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "supergroup", "title": f"Group {chat_id}"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "User"},
+    }
+    file = {"file_id": f"file-{update_id}", "file_unique_id": f"unique-{update_id}"}
+    if content == "text":
+        message["text"] = "hello"
+    elif content == "photo":
+        message["photo"] = [{**file, "width": 1280, "height": 720}]
+    elif content == "video":
+        message["video"] = {**file, "width": 1280, "height": 720, "duration": 10}
+    elif content == "document":
+        message["document"] = file
+    if edited:
+        message["edit_date"] = message["date"]
+        return {"update_id": update_id, "edited_message": message}
+    return {"update_id": update_id, "message": message}
+
+
+# Mixed traffic from authorized and regular users across the given groups
+def synthetic_updates(args, groups, authorized_users):
+    weights = [float(w) for w in args.mix.split(",")]
+    regular_users = range(1_000_000, 1_000_000 + args.users)
+    for update_id in range(1, args.updates + 1):
+        if authorized_users and random.random() < args.auth_ratio:
+            user_id = random.choice(authorized_users)
+        else:
+            user_id = random.choice(regular_users)
+        content = random.choices(CONTENT_TYPES, weights)[0]
+        yield message_update(update_id, random.choice(groups), user_id, content, random.random() < args.edit_ratio)
+
+
+def read_replay(path):
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def run_micro(args):
+    bot = import_bot()
+    groups = [-1000000000000 - i for i in range(args.groups)]
+    for chat_id in groups:
+        # Long timer so nothing is actually deleted while measuring
+        bot.state.update_group_settings(chat_id, auto_delete=True, delete_timer=3600)
+
+    application = bot.build_application(request=OfflineRequest())
+    await application.initialize()
+    updates = [
+        Update.de_json(message_update(i, random.choice(groups), random.randint(1, 10000)), application.bot)
+        for i in range(1, args.updates + 1)
+    ]
+
+    started = time.perf_counter()
+    for update in updates:
+        await application.process_update(update)
+    elapsed = time.perf_counter() - started
+
+    print(f"{args.updates} updates in {elapsed:.3f}s")
+    print(f"{elapsed / args.updates * 1e6:.1f} us per update ({args.updates / elapsed:.0f} updates/s)")
+    print(f"{len(bot.deletion_scheduler)} deletions scheduled, {len(asyncio.all_tasks())} tasks alive")
+    await application.shutdown()
+
+
+async def run_load(args):
+    bot = import_bot()
+    request = OfflineRequest()
+    application = bot.build_application(request=request)
+
+    if args.replay:
+        raw_updates = read_replay(args.replay)
+        groups = sorted({
+            (u.get("message") or u.get("edited_message") or {}).get("chat", {}).get("id")
+            for u in raw_updates
+        } - {None})
+        authorized_users = []
+    else:
+        groups = [-1000000000000 - i for i in range(args.groups)]
+        authorized_users = list(range(1, args.auth_users + 1))
+        raw_updates = list(synthetic_updates(args, groups, authorized_users))
+    for chat_id in groups:
+        bot.state.update_group_settings(chat_id, auto_delete=True, delete_timer=args.delete_timer)
+        for user_id in authorized_users:
+            bot.state.authorize(user_id, chat_id)
+
+    # Time the handler chain: group -100 runs first and group 100 last for every update
+    enqueued, started, handler_latency, end_to_end = {}, {}, [], []
+    async def mark_start(update, context):
+        started[update.update_id] = time.perf_counter()
+    async def mark_end(update, context):
+        now = time.perf_counter()
+        handler_latency.append(now - started.pop(update.update_id))
+        end_to_end.append(now - enqueued.pop(update.update_id))
+    application.add_handler(TypeHandler(Update, mark_start), group=-100)
+    application.add_handler(TypeHandler(Update, mark_end), group=100)
+
+    await application.initialize()
+    await application.post_init(application)
+    bot.deletion_scheduler.flush_interval = args.flush_interval
+    await application.start()
+    updates = [Update.de_json(u, application.bot) for u in raw_updates]
+
+    peak_tasks = 0
+    async def sample_tasks():
+        nonlocal peak_tasks
+        while True:
+            peak_tasks = max(peak_tasks, len(asyncio.all_tasks()))
+            await asyncio.sleep(0.01)
+    sampler = asyncio.create_task(sample_tasks())
+
+    began = time.perf_counter()
+    interval = 1 / args.rate if args.rate else 0
+    for update in updates:
+        enqueued[update.update_id] = time.perf_counter()
+        await application.update_queue.put(update)
+        if interval:
+            await asyncio.sleep(interval)
+    while len(end_to_end) < len(updates):
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - began
+    pending_after_run = len(bot.deletion_scheduler)
+
+    # Let the deletion scheduler catch up with everything that is already due. len() leaves
+    # out batches already popped and still waiting on the rate limiter, so count outcomes
+    scheduler = bot.deletion_scheduler
+    scheduled = bot.DELETIONS_SCHEDULED.total()
+    drain_started = time.perf_counter()
+    while args.delete_timer == 0 and scheduler.messages_deleted + scheduler.messages_skipped < scheduled:
+        if time.perf_counter() - drain_started > 30:
+            raise SystemExit(
+                f"Deletions did not drain within 30s: {scheduler.messages_deleted} deleted and "
+                f"{scheduler.messages_skipped} skipped of {scheduled} scheduled"
+            )
+        await asyncio.sleep(args.flush_interval)
+    drain_time = time.perf_counter() - drain_started
+    await asyncio.sleep(args.flush_interval * 2)
+    sampler.cancel()
+
+    print(f"{len(updates)} updates across {len(groups)} groups in {elapsed:.3f}s ({len(updates) / elapsed:.0f} updates/s)")
+    print(f"handler latency    p50 {percentile(handler_latency, 0.5) * 1e3:.3f} ms   p99 {percentile(handler_latency, 0.99) * 1e3:.3f} ms")
+    print(f"end-to-end latency p50 {percentile(end_to_end, 0.5) * 1e3:.3f} ms   p99 {percentile(end_to_end, 0.99) * 1e3:.3f} ms")
+    print(f"peak tasks {peak_tasks}, pending deletions {pending_after_run} after run / {len(scheduler)} after drain")
+    if args.delete_timer == 0:
+        print(f"deletions: {scheduler.messages_deleted} of {scheduled} deleted in {scheduler.api_calls} calls, "
+              f"drained {drain_time:.3f}s after the run")
+    print(f"RSS {rss_mb():.1f} MB")
+    print("Bot API calls:")
+    print("  " + request.api.report().replace("\n", "\n  "))
+
+    await application.stop()
+    await application.shutdown()
+    await application.post_shutdown(application)
+
+
+# Bytes allocated while building the result of `factory`, which is kept alive
+def measure_memory(factory):
+    tracemalloc.start()
+    value = factory()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return value, size
+
+
+def time_per_call(function, values):
+    started = time.perf_counter()
+    for value in values:
+        function(value)
+    return (time.perf_counter() - started) / len(values)
+
+
+def run_idset(args):
+    bot = import_bot()
+    # Kept in an array so each container has to create its own int objects, as when loading from SQLite
+    user_ids = array("q", random.sample(range(1, 8_000_000_000), args.ids))
+    group_ids = random.sample(range(-1_009_999_999_999, -1_000_000_000_000), max(1, args.ids // 100))
+    probes = random.sample(user_ids, 10000) + random.sample(range(1, 8_000_000_000), 10000)
+
+    for name, build in (("set", set), ("IdSet", bot.IdSet)):
+        users, size = measure_memory(lambda: build(user_ids))
+        groups = build(group_ids)
+        lookup = time_per_call(users.__contains__, probes)
+        started = time.perf_counter()
+        union = users | groups
+        union_time = time.perf_counter() - started
+        started = time.perf_counter()
+        for user_id in probes[10000:11000]:
+            users.add(user_id)
+        add_time = (time.perf_counter() - started) / 1000
+        print(
+            f"{name:6} {args.ids} ids: {size / 2**20:7.1f} MB ({size / args.ids:5.1f} B/id), "
+            f"lookup {lookup * 1e9:5.0f} ns, add {add_time * 1e9:6.0f} ns, union with {len(groups)} groups "
+            f"{union_time * 1e3:6.1f} ms ({len(union)} ids)"
+        )
+
+    id_set = bot.IdSet(user_ids)
+    started = time.perf_counter()
+    as_json = json.dumps(sorted(user_ids), indent=4)
+    json_time = time.perf_counter() - started
+    started = time.perf_counter()
+    blob = id_set.to_bytes()
+    blob_time = time.perf_counter() - started
+    started = time.perf_counter()
+    restored = bot.IdSet.from_bytes(blob)
+    restore_time = time.perf_counter() - started
+    assert len(restored) == len(id_set)
+    print(f"json.dumps(indent=4): {len(as_json) / 2**20:6.1f} MB in {json_time * 1e3:7.1f} ms")
+    print(f"IdSet.to_bytes:       {len(blob) / 2**20:6.1f} MB in {blob_time * 1e3:7.1f} ms "
+          f"(from_bytes {restore_time * 1e3:.1f} ms)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    micro = commands.add_parser("micro", help="per-update handler overhead")
+    micro.add_argument("--updates", type=int, default=20000)
+    micro.add_argument("--groups", type=int, default=100)
+
+    load = commands.add_parser("load", help="synthetic or replayed traffic through the running application")
+    load.add_argument("--updates", type=int, default=50000)
+    load.add_argument("--groups", type=int, default=100)
+    load.add_argument("--users", type=int, default=10000, help="regular (non-authorized) senders")
+    load.add_argument("--auth-users", type=int, default=20, help="users authorized in every group")
+    load.add_argument("--auth-ratio", type=float, default=0.2, help="share of messages from authorized users")
+    load.add_argument("--edit-ratio", type=float, default=0.02, help="share of updates that are edits")
+    load.add_argument("--mix", default="60,20,10,10", help="text,photo,video,document weights")
+    load.add_argument("--delete-timer", type=float, default=0, help="seconds before messages are deleted")
+    load.add_argument("--flush-interval", type=float, default=0.1, help="deletion scheduler flush interval")
+    load.add_argument("--rate", type=float, default=0, help="updates per second to feed (0 = as fast as possible)")
+    load.add_argument("--replay", help="JSON lines file of recorded updates (see UPDATE_LOG_FILE)")
+
+    idset = commands.add_parser("idset", help="memory and speed of IdSet against a plain set")
+    idset.add_argument("--ids", type=int, default=1_000_000)
+
+    args = parser.parse_args()
+    if args.command == "idset":
+        run_idset(args)
+    else:
+        asyncio.run(run_micro(args) if args.command == "micro" else run_load(args))
@@ -0,0 +1,147 @@
+"""Minimal local stand-in for the Telegram Bot API.
+
+Run it and point the bot at it to exercise the bot without touching Telegram:
+
+    python fake_bot_api.py --port 8081
+    BOT_API_BASE_URL=http://127.0.0.1:8081/bot python Copyrightsaver_bot.py
+
+Every call is counted per method and printed when the server stops. Updates
+for getUpdates can be queued by POSTing a JSON update (or a list of them) to
+/_updates.
+"""
+import argparse
+import asyncio
+import json
+import signal
+import time
+from collections import Counter
+from urllib.parse import parse_qs
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+
+
+class FakeBotAPI:
+    def __init__(self):
+        self.calls = Counter()
+        self.deleted_messages = 0
+        self.updates = asyncio.Queue()
+        self._message_id = 0
+
+    def _message(self, params):
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+            "text": params.get("text", ""),
+        }
+
+    # Returns the result payload for a Bot API method call
+    async def call(self, method, params):
+        self.calls[method] += 1
+        if method == "getMe":
+            return BOT_USER
+        if method == "getUpdates":
+            timeout = float(params.get("timeout", 0))
+            updates = []
+            try:
+                updates.append(await asyncio.wait_for(self.updates.get(), timeout))
+            except asyncio.TimeoutError:
+                return []
+            while not self.updates.empty() and len(updates) < 100:
+                updates.append(self.updates.get_nowait())
+            return updates
+        if method == "deleteMessages":
+            self.deleted_messages += len(params.get("message_ids", []))
+        elif method == "deleteMessage":
+            self.deleted_messages += 1
+        if method.startswith("send") or method in ("copyMessage", "editMessageText"):
+            return self._message(params)
+        if method == "getChatAdministrators":
+            return []
+        if method == "getChat":
+            chat_id = int(params.get("chat_id", 0))
+            return {"id": chat_id, "type": "supergroup", "title": f"Group {chat_id}", "accent_color_id": 0, "max_reaction_count": 11}
+        return True
+
+    def report(self):
+        lines = [f"{method}: {count}" for method, count in self.calls.most_common()]
+        lines.append(f"messages deleted: {self.deleted_messages}")
+        return "\n".join(lines)
+
+
+# Decodes the parameters of a form-encoded or JSON request body
+def parse_params(content_type, body):
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    params = {}
+    for key, values in parse_qs(body.decode()).items():
+        try:
+            params[key] = json.loads(values[0])
+        except ValueError:
+            params[key] = values[0]
+    return params
+
+
+async def handle_connection(api, reader, writer):
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            _, path, _ = request_line.decode().split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode().partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            if path == "/_updates":
+                updates = json.loads(body)
+                for update in updates if isinstance(updates, list) else [updates]:
+                    api.updates.put_nowait(update)
+                payload = {"ok": True, "result": True}
+            else:
+                method = path.rsplit("/", 1)[-1]
+                params = parse_params(headers.get("content-type", ""), body)
+                payload = {"ok": True, "result": await api.call(method, params)}
+
+            response = json.dumps(payload).encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                + f"Content-Length: {len(response)}\r\n\r\n".encode()
+                + response
+            )
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host, port):
+    api = FakeBotAPI()
+    server = await asyncio.start_server(lambda r, w: handle_connection(api, r, w), host, port)
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    print(f"Fake Bot API listening on http://{host}:{port}/bot")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        print(api.report())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
@@ -0,0 +1,16 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+
+# The bot keeps its databases and logs relative to the working directory
+@pytest.fixture(scope="session")
+def bot():
+    os.chdir(tempfile.mkdtemp(prefix="bot-tests-"))
+    import Copyrightsaver_bot
+    return Copyrightsaver_bot
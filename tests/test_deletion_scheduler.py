@@ -0,0 +1,142 @@
+import time
+
+import pytest
+
+
+@pytest.fixture
+def scheduler(bot, tmp_path):
+    scheduler = bot.DeletionScheduler(str(tmp_path / "deletions.db"))
+    scheduler.load()
+    return scheduler
+
+
+def journal(scheduler):
+    return sorted(scheduler._db.execute("SELECT chat_id, message_id FROM pending_deletions").fetchall())
+
+
+def reopen(bot, scheduler):
+    reloaded = bot.DeletionScheduler(scheduler.db_path)
+    reloaded.load()
+    return reloaded
+
+
+def test_schedule_is_journaled(bot, scheduler):
+    scheduler.schedule(-1, 10, 60)
+    scheduler.schedule(-2, 20, 60)
+    scheduler._flush_journal()
+    assert journal(scheduler) == [(-2, 20), (-1, 10)]
+    assert len(reopen(bot, scheduler)) == 2
+
+
+def test_drop_chat_skips_entries(scheduler):
+    scheduler.schedule(-1, 10, 0)
+    scheduler.schedule(-1, 11, 0)
+    scheduler.schedule(-2, 20, 0)
+    assert scheduler.drop_chat(-1) == 2
+    assert len(scheduler) == 1
+    assert scheduler.messages_skipped == 2
+    assert scheduler._pop_due() == {-2: [20]}
+    assert len(scheduler) == 0
+    assert not scheduler._heap
+    assert not scheduler._tombstones
+
+
+def test_drop_chat_without_pending_deletions(scheduler):
+    assert scheduler.drop_chat(-1) == 0
+    assert not scheduler._tombstones
+
+
+def test_later_messages_survive_tombstone(scheduler):
+    scheduler.schedule(-1, 10, 0)
+    scheduler.drop_chat(-1)
+    scheduler.schedule(-1, 11, 0)
+    assert len(scheduler) == 1
+    assert scheduler._pop_due() == {-1: [11]}
+
+
+def test_schedule_below_tombstone_purges_dead_entries(scheduler):
+    scheduler.schedule(-1, 50, 0)
+    scheduler.drop_chat(-1)
+    scheduler.schedule(-1, 40, 0)
+    assert not scheduler._tombstones
+    assert scheduler._dead == 0
+    assert scheduler._pop_due() == {-1: [40]}
+
+
+def test_dropped_rows_leave_the_journal(scheduler):
+    scheduler.schedule(-1, 10, 60)
+    scheduler.schedule(-2, 20, 60)
+    scheduler._flush_journal()
+    scheduler.schedule(-1, 11, 60)
+    scheduler.drop_chat(-1)
+    scheduler._flush_journal()
+    assert journal(scheduler) == [(-2, 20)]
+
+
+def test_schedule_below_tombstone_is_journaled(bot, scheduler):
+    scheduler.schedule(-1, 50, 60)
+    scheduler._flush_journal()
+    scheduler.drop_chat(-1)
+    scheduler.schedule(-1, 40, 60)
+    scheduler._flush_journal()
+    assert journal(scheduler) == [(-1, 40)]
+    reloaded = reopen(bot, scheduler)
+    assert [entry[1:] for entry in reloaded._heap] == [(-1, 40)]
+
+
+def test_schedule_below_unflushed_tombstone_is_journaled(scheduler):
+    scheduler.schedule(-1, 50, 60)
+    scheduler.drop_chat(-1)
+    scheduler.schedule(-1, 40, 60)
+    scheduler._flush_journal()
+    assert journal(scheduler) == [(-1, 40)]
+
+
+def test_rescheduling_sooner_supersedes_the_pending_entry(bot, scheduler):
+    scheduled = bot.DELETIONS_SCHEDULED.total()
+    scheduler.schedule(-1, 10, 0.001)
+    scheduler.schedule(-1, 10, 0)
+    assert len(scheduler) == 1
+    assert bot.DELETIONS_SCHEDULED.total() == scheduled + 1
+    time.sleep(0.01)
+    # The superseded entry is due too, but only one deletion is sent
+    assert scheduler._pop_due() == {-1: [10]}
+    assert len(scheduler) == 0
+    assert not scheduler._heap and not scheduler._superseded
+
+
+def test_rescheduling_later_is_ignored(scheduler):
+    scheduler.schedule(-1, 10, 0)
+    scheduler.schedule(-1, 10, 60)
+    assert len(scheduler._heap) == 1
+    assert scheduler._pop_due() == {-1: [10]}
+
+
+def test_rescheduled_message_is_journaled_once(bot, scheduler):
+    scheduler.schedule(-1, 10, 60)
+    scheduler._flush_journal()
+    scheduler.schedule(-1, 10, 5)
+    scheduler._flush_journal()
+    assert journal(scheduler) == [(-1, 10)]
+    reloaded = reopen(bot, scheduler)
+    assert len(reloaded) == 1 and reloaded._heap[0][0] < scheduler._heap[-1][0] + 60
+
+
+def test_drop_chat_with_superseded_entries(scheduler):
+    scheduler.schedule(-1, 10, 0.001)
+    scheduler.schedule(-1, 10, 0)
+    scheduler.schedule(-1, 11, 0)
+    assert scheduler.drop_chat(-1) == 2
+    assert len(scheduler) == 0
+    time.sleep(0.01)
+    assert scheduler._pop_due() == {}
+    assert not scheduler._heap and not scheduler._superseded and scheduler._dead == 0
+
+
+def test_purge_forgets_superseded_entries(scheduler):
+    scheduler.schedule(-1, 50, 60)
+    scheduler.schedule(-1, 50, 30)
+    scheduler.drop_chat(-1)
+    scheduler.schedule(-1, 40, 0)
+    assert not scheduler._superseded
+    assert len(scheduler) == 1 and len(scheduler._heap) == 1
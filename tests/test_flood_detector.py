@@ -0,0 +1,53 @@
+import pytest
+
+
+@pytest.fixture
+def detector(bot):
+    return bot.FloodDetector(max_counters=100)
+
+
+def test_counts_per_chat_and_user(detector):
+    assert [detector.hit(-1, 1, 8, now=100.0) for _ in range(3)] == [1, 2, 3]
+    assert detector.hit(-1, 2, 8, now=100.0) == 1
+    assert detector.hit(-2, 1, 8, now=100.0) == 1
+    assert len(detector) == 3
+
+
+def test_window_slides_one_bucket_at_a_time(detector):
+    # An 8 second window has 1 second buckets
+    for now in (100.0, 101.5, 103.0, 107.9):
+        detector.hit(-1, 1, 8, now=now)
+    assert detector.hit(-1, 1, 8, now=108.0) == 4  # The message at 100.0 slid out
+    assert detector.hit(-1, 1, 8, now=110.0) == 4  # So did 101.5
+    assert detector.hit(-1, 1, 8, now=111.0) == 4  # And 103.0
+
+
+def test_idle_counter_restarts(detector):
+    for _ in range(5):
+        detector.hit(-1, 1, 8, now=100.0)
+    assert detector.hit(-1, 1, 8, now=108.0) == 1
+    assert detector.hit(-1, 1, 8, now=200.0) == 1
+
+
+def test_window_change_restarts_counter(detector):
+    for _ in range(5):
+        detector.hit(-1, 1, 8, now=100.0)
+    assert detector.hit(-1, 1, 16, now=100.0) == 1
+
+
+def test_idle_counters_are_evicted(detector):
+    detector.hit(-1, 1, 8, now=100.0)
+    detector.hit(-1, 2, 8, now=104.0)
+    detector.hit(-1, 3, 8, now=108.0)
+    assert list(detector._counters) == [(-1, 2), (-1, 3)]
+
+
+def test_counters_are_capped_least_recently_used_first(bot):
+    detector = bot.FloodDetector(max_counters=2)
+    detector.hit(-1, 1, 8, now=100.0)
+    detector.hit(-1, 2, 8, now=100.0)
+    detector.hit(-1, 1, 8, now=100.0)
+    detector.hit(-1, 3, 8, now=100.0)
+    assert list(detector._counters) == [(-1, 1), (-1, 3)]
+    assert detector.hit(-1, 2, 8, now=100.0) == 1
+    assert detector.hit(-1, 3, 8, now=100.0) == 2
@@ -0,0 +1,85 @@
+import random
+
+import pytest
+
+
+@pytest.fixture
+def IdSet(bot):
+    return bot.IdSet
+
+
+def test_constructor_dedupes_and_sorts(IdSet):
+    ids = IdSet([5, -3, 5, 2])
+    assert list(ids) == [-3, 2, 5]
+    assert len(ids) == 3
+    assert 2 in ids and 4 not in ids
+
+
+def test_add_and_discard(IdSet):
+    ids = IdSet([1, 2, 3])
+    ids.add(10)
+    ids.add(10)
+    ids.add(2)
+    ids.discard(3)
+    ids.discard(3)
+    ids.discard(99)
+    assert len(ids) == 3
+    assert list(ids) == [1, 2, 10]
+    assert 3 not in ids and 10 in ids
+
+
+def test_readding_a_discarded_id(IdSet):
+    ids = IdSet([1, 2])
+    ids.discard(2)
+    ids.add(2)
+    ids.add(0)
+    ids.discard(0)
+    assert list(ids) == [1, 2]
+    assert len(ids) == 2
+
+
+def test_merge_keeps_contents(IdSet):
+    ids = IdSet(range(0, 10_000, 2))
+    expected = set(range(0, 10_000, 2))
+    rng = random.Random(1)
+    for _ in range(5_000):
+        id_ = rng.randrange(-100, 10_100)
+        if rng.random() < 0.5:
+            ids.add(id_)
+            expected.add(id_)
+        else:
+            ids.discard(id_)
+            expected.discard(id_)
+    assert len(ids._added) + len(ids._removed) <= max(ids.MERGE_MIN, len(ids._ids) >> 6)
+    assert len(ids) == len(expected)
+    assert list(ids) == sorted(expected)
+    assert all(id_ in ids for id_ in expected)
+    ids._merge()
+    assert list(ids._ids) == sorted(expected)
+
+
+def test_union(IdSet):
+    left = IdSet([1, 3, 5])
+    left.add(7)
+    right = IdSet([2, 3])
+    right.discard(2)
+    assert list(left | right) == [1, 3, 5, 7]
+    assert list(right | {4, 1}) == [1, 3, 4]
+    assert list({4, 1} | right) == [1, 3, 4]
+
+
+def test_bytes_round_trip(IdSet):
+    ids = IdSet([3, -7, 2**40])
+    ids.add(5)
+    ids.discard(3)
+    blob = ids.to_bytes()
+    assert len(blob) == 3 * 8
+    assert blob[:8] == (-7).to_bytes(8, "little", signed=True)
+    assert list(IdSet.from_bytes(blob)) == [-7, 5, 2**40]
+
+
+def test_empty(IdSet):
+    ids = IdSet()
+    assert len(ids) == 0
+    assert list(ids) == []
+    assert IdSet.from_bytes(ids.to_bytes())._ids.tolist() == []
@@ -0,0 +1,91 @@
+import asyncio
+import types
+
+import pytest
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+        self.edits = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+        return types.SimpleNamespace(message_id=len(self.sent))
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        self.edits.append((message_id, text))
+
+
+@pytest.fixture
+def runner(bot, tmp_path, monkeypatch):
+    runner = bot.JobRunner(str(tmp_path / "journal.db"), concurrency=1)
+    runner.start(FakeBot())
+    monkeypatch.setattr(bot, "job_runner", runner)
+    return runner
+
+
+@pytest.fixture
+def kinds(bot, monkeypatch):
+    finished = []
+
+    async def block(job):
+        await asyncio.sleep(3600)
+
+    monkeypatch.setitem(bot.JOB_KINDS, "block", block)
+    monkeypatch.setitem(bot.JOB_FINISHERS, "block", lambda job, status: finished.append((job.id, status)))
+    return finished
+
+
+def row(runner, job_id):
+    return runner.db.execute("SELECT status, finished_ts IS NOT NULL FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+
+def test_cancel_while_waiting_for_a_slot_finishes_the_job(runner, kinds):
+    async def run():
+        first = await runner.adopt("block", {}, 1)
+        second = await runner.adopt("block", {}, 1)
+        await asyncio.sleep(0.01)
+        assert row(runner, second) == ("queued", 0)
+        assert runner.cancel(second)
+        await asyncio.sleep(0.01)
+        runner.cancel(first)
+        await asyncio.sleep(0.01)
+        return first, second
+    first, second = asyncio.run(run())
+    assert row(runner, second) == ("cancelled", 1)
+    assert kinds == [(second, "cancelled"), (first, "cancelled")]
+    assert runner.bot.edits[-2:] == [(2, f"Job {second} (block) cancelled"), (1, f"Job {first} (block) cancelled")]
+
+
+def test_job_cancelled_elsewhere_before_it_starts_is_finished(runner, kinds):
+    async def run():
+        job = runner._create("block", {}, 1)
+        with runner.db:
+            runner.db.execute("UPDATE jobs SET status = 'cancelled' WHERE id = ?", (job.id,))
+        await runner._run(job)
+        return job.id
+    job_id = asyncio.run(run())
+    assert row(runner, job_id) == ("cancelled", 1)
+    assert kinds == [(job_id, "cancelled")]
+
+
+def test_orphaned_broadcasts_are_adopted(bot, runner, tmp_path, monkeypatch):
+    engine = bot.BroadcastEngine(str(tmp_path / "journal.db"))
+    engine.start(runner.bot)
+    monkeypatch.setattr(bot, "broadcast_engine", engine)
+    orphan = engine.create("send_message", {"text": "hi"}, [5, 6])
+    with engine.db:
+        engine.db.execute("UPDATE broadcasts SET report_chat_id = 42 WHERE id = ?", (orphan,))
+    owned = engine.create("send_message", {"text": "hello"}, [7])
+    runner._create("broadcast", {"broadcast_id": owned}, 1)
+
+    async def run():
+        await bot.adopt_broadcasts()
+        await asyncio.gather(*runner._tasks.values())
+    asyncio.run(run())
+    assert runner.params("broadcast") == [{"broadcast_id": owned}, {"broadcast_id": orphan}]
+    assert engine.unfinished() == [(owned, None)]
+    assert (5, "hi") in runner.bot.sent and (6, "hi") in runner.bot.sent
+    assert runner.bot.sent[0][0] == 42
+    assert runner.bot.edits[-1][1].startswith("Job 2 (broadcast) done: 2/2 (100%)")
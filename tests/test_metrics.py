@@ -0,0 +1,63 @@
+import pytest
+
+
+@pytest.fixture
+def histogram(bot):
+    return bot.Histogram("test_seconds", "Test histogram.", buckets=(1, 5, 10))
+
+
+def buckets(histogram):
+    return {labels["le"]: value for name, labels, value in histogram.samples() if name.endswith("_bucket")}
+
+
+def test_histogram_buckets_are_cumulative(histogram):
+    for value in (0.5, 1, 3, 7, 7):
+        histogram.observe(value)
+    assert buckets(histogram) == {"1": 2, "5": 3, "10": 5, "+Inf": 5}
+
+
+def test_histogram_overflow_does_not_touch_sum(histogram):
+    histogram.observe(100)
+    samples = {name: value for name, labels, value in histogram.samples() if not name.endswith("_bucket")}
+    assert samples == {"test_seconds_sum": 100, "test_seconds_count": 1}
+    assert buckets(histogram) == {"1": 0, "5": 0, "10": 0, "+Inf": 1}
+    assert histogram.mean() == 100
+
+
+def test_histogram_mean_spans_labels(bot):
+    histogram = bot.Histogram("test_seconds", "Test histogram.", ("method",))
+    histogram.observe(1, "a")
+    histogram.observe(3, "b")
+    histogram.observe(20, "b")
+    assert histogram.mean() == 8
+    assert histogram.mean() == pytest.approx(sum(v for n, _, v in histogram.samples() if n.endswith("_sum")) / 3)
+
+
+def test_empty_histogram_mean(histogram):
+    assert histogram.mean() == 0.0
+
+
+def test_counter_labels(bot):
+    counter = bot.Counter("test_total", "Test counter.", ("result",))
+    counter.inc("ok")
+    counter.inc("ok", amount=2)
+    counter.inc("failed")
+    assert counter.total() == 4
+    assert list(counter.samples()) == [
+        ("test_total", {"result": "ok"}, 3),
+        ("test_total", {"result": "failed"}, 1),
+    ]
+
+
+def test_render(bot):
+    registry = bot.MetricsRegistry()
+    registry.counter("test_total", "Test counter.").inc()
+    registry.callback("test_queue", "Test gauge.", "gauge", lambda: 7)
+    assert registry.render() == (
+        "# HELP test_total Test counter.\n"
+        "# TYPE test_total counter\n"
+        "test_total 1\n"
+        "# HELP test_queue Test gauge.\n"
+        "# TYPE test_queue gauge\n"
+        "test_queue 7\n"
+    )
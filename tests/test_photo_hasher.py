@@ -0,0 +1,39 @@
+import asyncio
+import types
+
+
+class FakeBot:
+    def __init__(self):
+        self.get_file_calls = 0
+
+    async def get_file(self, file_id, **kwargs):
+        self.get_file_calls += 1
+        raise RuntimeError("offline")
+
+
+def photo_message():
+    photo = types.SimpleNamespace(file_id="f", file_unique_id="u")
+    return types.SimpleNamespace(photo=[photo], chat=types.SimpleNamespace(id=-5), message_id=1)
+
+
+def test_photos_are_not_downloaded_without_flagged_hashes(bot, monkeypatch):
+    monkeypatch.setattr(bot.media_index, "phashes", [])
+    hasher, fake = bot.PhotoHasher(workers=1), FakeBot()
+
+    async def run():
+        hasher.check(fake, photo_message())
+        await asyncio.sleep(0)
+    asyncio.run(run())
+    assert fake.get_file_calls == 0
+    assert hasher._pending == 0
+
+
+def test_photos_are_hashed_once_something_is_flagged(bot, monkeypatch):
+    monkeypatch.setattr(bot.media_index, "phashes", [(0, -5)])
+    hasher, fake = bot.PhotoHasher(workers=1), FakeBot()
+
+    async def run():
+        hasher.check(fake, photo_message())
+        await asyncio.sleep(0.01)
+    asyncio.run(run())
+    assert fake.get_file_calls == 1
@@ -0,0 +1,65 @@
+import asyncio
+import time
+
+import pytest
+from telegram.error import RetryAfter
+
+
+@pytest.fixture
+def limiter(bot, monkeypatch):
+    monkeypatch.setattr(bot, "RETRY_AFTER_JITTER", 0)
+    return bot.ApiRateLimiter(rate=1000, max_retries=0)
+
+
+def call(limiter, endpoint, data, lane, result=None, error=None):
+    calls = []
+
+    async def callback():
+        calls.append(endpoint)
+        if error is not None:
+            raise error
+        return result
+
+    async def run():
+        return await limiter.process_request(callback, (), {}, endpoint, data, lane)
+    return asyncio.run(run()), calls
+
+
+def test_retry_after_on_send_pauses_chat_bucket(bot, limiter):
+    with pytest.raises(RetryAfter):
+        call(limiter, "sendMessage", {"chat_id": -1}, bot.LANE_BACKGROUND, error=RetryAfter(5))
+    assert limiter._chat_bucket(-1).paused_for() > 4
+    assert limiter._chat_bucket(-2).paused_for() == 0
+    assert limiter.bucket.paused_for() == 0
+
+
+def test_retry_after_elsewhere_pauses_global_bucket(bot, limiter):
+    with pytest.raises(RetryAfter):
+        call(limiter, "getChat", {"chat_id": -1}, bot.LANE_BACKGROUND, error=RetryAfter(5))
+    assert limiter.bucket.paused_for() > 4
+    assert limiter._chat_bucket(-1).paused_for() == 0
+
+
+def test_interactive_send_is_not_retried(bot):
+    limiter = bot.ApiRateLimiter(rate=1000, max_retries=3)
+    with pytest.raises(RetryAfter):
+        call(limiter, "sendMessage", {"chat_id": -1}, None, error=RetryAfter(5))
+    assert limiter._chat_bucket(-1).paused_for() > 4
+
+
+def test_interactive_send_fails_fast_in_paused_chat(limiter):
+    limiter._chat_bucket(-1).pause(5)
+    with pytest.raises(RetryAfter) as error:
+        call(limiter, "sendMessage", {"chat_id": -1}, None)
+    assert error.value.retry_after == 5
+    assert call(limiter, "sendMessage", {"chat_id": -2}, None, result="sent") == ("sent", ["sendMessage"])
+
+
+def test_interactive_sends_do_not_wait_on_chat_bucket(bot, limiter):
+    # Private chats allow one message per second
+    started = time.monotonic()
+    for _ in range(5):
+        assert call(limiter, "sendMessage", {"chat_id": 1}, None, result="sent")[0] == "sent"
+    assert time.monotonic() - started < 0.5
+    # ...but the tokens they took still hold back queued background sends
+    assert limiter._chat_bucket(1)._tokens < 0
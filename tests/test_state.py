@@ -0,0 +1,159 @@
+import asyncio
+import sqlite3
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "bot.db")
+
+
+@pytest.fixture
+def open_storage(bot, db_path):
+    def open_storage():
+        storage = bot.Storage(db_path)
+        storage.open()
+        return storage
+    return open_storage
+
+
+@pytest.fixture
+def open_state(bot, db_path):
+    def open_state():
+        state = bot.BotState(bot.Storage(db_path))
+        state.load()
+        return state
+    return open_state
+
+
+def test_changes_are_logged_in_writer_key_form(open_storage):
+    storage = open_storage()
+    start = storage.last_change()
+    storage.write_changes({
+        ("user", 1): True,
+        ("auth", -5, 2): True,
+        ("setting", -5, "delete_timer"): 60,
+    })
+    storage.write_changes({("auth", -5, 2): False, ("setting", -5, "delete_timer"): 90})
+    changes = open_storage().changes_since(start)
+    assert [(key, value) for _, key, value in changes] == [
+        (("user", 1), True),
+        (("auth", -5, 2), True),
+        (("setting", -5, "delete_timer"), 60),
+        (("auth", -5, 2), False),
+        (("setting", -5, "delete_timer"), 90),
+    ]
+    assert open_storage().changes_since(changes[-1][0]) == []
+
+
+def test_external_edits_are_logged(open_storage, db_path):
+    storage = open_storage()
+    storage.write_changes({("setting", -5, "delete_timer"): 60, ("group", -5): True})
+    start = storage.last_change()
+    db = sqlite3.connect(db_path)
+    with db:
+        db.execute("DELETE FROM group_settings WHERE chat_id = -5")
+        db.execute("UPDATE groups SET chat_id = -6 WHERE chat_id = -5")
+    assert [(key, value) for _, key, value in storage.changes_since(start)] == [
+        (("setting", -5, "delete_timer"), None),
+        (("group", -5), False),
+        (("group", -6), True),
+    ]
+
+
+def test_pruned_changes_are_reported(bot, open_storage, monkeypatch):
+    monkeypatch.setattr(bot, "STATE_CHANGES_KEEP", 2)
+    storage = open_storage()
+    start = storage.last_change()
+    storage.write_changes({("user", user_id): True for user_id in range(5)})
+    assert storage.changes_since(start) is None
+    assert len(storage.changes_since(storage.last_change() - 2)) == 2
+    storage.write_changes({("user", 9): True})
+    assert storage.changes_since(start + 3) is None
+    assert len(storage.changes_since(start + 4)) == 2
+
+
+def test_watch_applies_changes_from_other_processes(open_state, db_path):
+    async def run():
+        local, remote = open_state(), open_state()
+        watcher = asyncio.create_task(local.watch(interval=0.01))
+        local.authorize(7, -5)  # Not committed yet
+        remote.update_group_settings(-5, flood_limit=60)
+        remote.authorize(8)
+        await remote.writer.flush()
+        await asyncio.sleep(0.1)
+        policy_before = local.policy(-5)
+        with sqlite3.connect(db_path) as db:
+            db.execute("UPDATE group_settings SET value = '90' WHERE chat_id = -5")
+            db.execute("DELETE FROM authorizations WHERE user_id = 8")
+        await asyncio.sleep(0.1)
+        watcher.cancel()
+        return local, policy_before
+    local, policy_before = asyncio.run(run())
+    assert policy_before.flood_limit == 60
+    assert local.get_group_settings(-5) == {"flood_limit": 90}
+    assert local.policy(-5).flood_limit == 90
+    assert local.is_exempt(7, -5)
+    assert not local.is_exempt(8, -1)
+
+
+def test_watch_reloads_when_too_far_behind(bot, open_state, monkeypatch):
+    monkeypatch.setattr(bot, "STATE_CHANGES_KEEP", 1)
+
+    async def run():
+        local, remote = open_state(), open_state()
+        watcher = asyncio.create_task(local.watch(interval=0.01))
+        for user_id in range(3):
+            remote.authorize(user_id)
+        await remote.writer.flush()
+        await asyncio.sleep(0.1)
+        watcher.cancel()
+        return local
+    assert asyncio.run(run()).global_authorized_users == {0, 1, 2}
+
+
+def test_remove_chat_forgets_user_ids_listed_as_groups(bot, open_state):
+    state = open_state()
+    registry = bot.Registry(state)
+    registry.add_user(42)
+    registry.add_group(42)  # As imported from legacy group_ids
+    registry.add_group(-100)
+    registry.remove_chat(42)
+    assert 42 not in state.started_users and 42 not in state.group_ids
+    assert state.writer.dirty[("user", 42)] is False and state.writer.dirty[("group", 42)] is False
+    registry.remove_chat(-100)
+    assert list(state.group_ids) == []
+
+
+def test_concurrent_json_migration_runs_once(bot, open_storage, db_path, tmp_path):
+    json_path = tmp_path / "data.json"
+    json_path.write_text('{"started_users": [1, 2], "group_authorized_users": {"-5": [3]}}')
+    storages = [open_storage() for _ in range(4)]
+    barrier = threading.Barrier(len(storages))
+    results = []
+
+    def migrate(storage):
+        barrier.wait()
+        results.append(storage.migrate_from_json(str(json_path)))
+
+    threads = [threading.Thread(target=migrate, args=(storage,)) for storage in storages]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [False, False, False, True]
+    changes = storages[0].changes_since(0)
+    assert [key for _, key, _ in changes] == [("user", 1), ("user", 2), ("auth", -5, 3)]
+    assert storages[0].migrate_from_json(str(json_path)) is False
+
+
+def test_group_authorizations_are_plain_sets(open_state, db_path):
+    state = open_state()
+    state.authorize(7, -5)
+    state.writer.close()
+    reloaded = open_state()
+    assert type(state.group_authorized_users[-5]) is set
+    assert type(reloaded.group_authorized_users[-5]) is set
+    assert reloaded.is_exempt(7, -5) and not reloaded.is_exempt(7, -6)
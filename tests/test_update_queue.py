@@ -0,0 +1,22 @@
+import asyncio
+
+
+def test_put_waits_until_an_update_is_handled(bot):
+    async def run():
+        queue = bot.UpdateQueue(limit=2)
+        await queue.put(1)
+        await queue.put(2)
+        # Taken off the queue but not handled yet: still counts
+        assert await queue.get() == 1
+        blocked = asyncio.create_task(queue.put(3))
+        await asyncio.sleep(0.01)
+        assert not blocked.done()
+        queue.task_done()
+        await asyncio.wait_for(blocked, 1)
+        assert queue.in_flight == 2
+        return [queue.get_nowait(), queue.get_nowait()]
+    assert asyncio.run(run()) == [2, 3]
+
+
+def test_application_uses_bounded_queue(bot):
+    assert isinstance(bot.api_builder().build().update_queue, bot.UpdateQueue)
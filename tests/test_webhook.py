@@ -0,0 +1,116 @@
+import asyncio
+import json
+
+import pytest
+
+
+class FakeApplication:
+    def __init__(self):
+        self.bot = None
+        self.update_queue = asyncio.Queue()
+
+
+async def post(port, body, secret="s3cret", length=None, path=None):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    headers = f"Content-Length: {len(body) if length is None else length}\r\n"
+    if secret is not None:
+        headers += f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\n"
+    writer.write(f"POST {path} HTTP/1.1\r\n{headers}\r\n".encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    writer.close()
+    return status
+
+
+@pytest.fixture
+def serve(bot):
+    async def serve(requests):
+        application = FakeApplication()
+        server = bot.HttpServer(
+            bot.webhook_handler(application), "127.0.0.1", 0, check=bot.webhook_check("s3cret")
+        )
+        await server.start()
+        port = server._server.sockets[0].getsockname()[1]
+        try:
+            statuses = [await post(port, path=bot.WEBHOOK_PATH, **request) for request in requests]
+        finally:
+            await server.stop()
+        return statuses, application.update_queue.qsize()
+    return lambda *requests: asyncio.run(serve(requests))
+
+
+UPDATE = json.dumps({"update_id": 1}).encode()
+
+
+def test_accepts_update_with_secret(serve):
+    assert serve({"body": UPDATE}) == ([200], 1)
+
+
+def test_refuses_missing_or_wrong_secret(serve):
+    assert serve({"body": UPDATE, "secret": None}, {"body": UPDATE, "secret": "guess"}) == ([403, 403], 0)
+
+
+def test_checks_secret_before_reading_body(serve):
+    # The announced body never arrives; the request must still be answered
+    assert serve({"body": b"", "secret": "guess", "length": 10_000}) == ([403], 0)
+
+
+def test_refuses_oversized_body(bot, serve):
+    assert serve({"body": b"", "length": bot.WEBHOOK_MAX_BODY + 1}) == ([413], 0)
+
+
+@pytest.mark.parametrize("body", [b"[1]", b"not json", b"null", b'{"message": 1}'])
+def test_rejects_malformed_update(serve, body):
+    assert serve({"body": body}) == ([400], 0)
+
+
+@pytest.fixture
+def raw(bot, monkeypatch):
+    monkeypatch.setattr(bot, "HTTP_READ_TIMEOUT", 0.1)
+
+    # Sends `chunks` and returns the status line's code, or None if the server just closed
+    async def raw(*chunks):
+        server = bot.HttpServer(
+            bot.webhook_handler(FakeApplication()), "127.0.0.1", 0, check=bot.webhook_check("s3cret")
+        )
+        await server.start()
+        reader, writer = await asyncio.open_connection("127.0.0.1", server._server.sockets[0].getsockname()[1])
+        try:
+            for chunk in chunks:
+                writer.write(chunk)
+            await writer.drain()
+            status_line = await asyncio.wait_for(reader.readline(), 1)
+            return int(status_line.split()[1]) if status_line else None
+        finally:
+            writer.close()
+            await server.stop()
+    return lambda *chunks: asyncio.run(raw(*chunks))
+
+
+def test_slow_headers_time_out(bot, raw):
+    assert raw(f"POST {bot.WEBHOOK_PATH} HTTP/1.1\r\nContent-Length: 2\r\n".encode()) == 408
+
+
+def test_slow_body_times_out(bot, raw):
+    request = f"POST {bot.WEBHOOK_PATH} HTTP/1.1\r\nX-Telegram-Bot-Api-Secret-Token: s3cret\r\nContent-Length: 10\r\n\r\n{{"
+    assert raw(request.encode()) == 408
+
+
+def test_idle_connection_is_closed(raw):
+    assert raw() is None
+
+
+def test_too_many_header_lines(bot, raw):
+    headers = "".join(f"X-{i}: 1\r\n" for i in range(bot.HTTP_MAX_HEADERS + 1))
+    assert raw(f"POST {bot.WEBHOOK_PATH} HTTP/1.1\r\n{headers}\r\n".encode()) == 431
+
+
+def test_oversized_header_line(bot, raw):
+    header = "X-Big: " + "a" * bot.HTTP_MAX_HEADER_BYTES
+    assert raw(f"POST {bot.WEBHOOK_PATH} HTTP/1.1\r\n{header}\r\n\r\n".encode()) == 431
+
+
+def test_run_webhook_requires_url(bot, monkeypatch):
+    monkeypatch.setattr(bot, "WEBHOOK_URL", "")
+    with pytest.raises(SystemExit):
+        asyncio.run(bot.run_webhook(None))